@@ -1,129 +1,1397 @@
 import streamlit as st
 import requests
-from PIL import Image
+from requests.adapters import HTTPAdapter
 import io
 import os
 from dotenv import load_dotenv
 import time
-from duckduckgo_search import DDGS
 import uuid
-import smtplib
-from email.mime.text import MIMEText
-from streamlit_lottie import st_lottie
 import json
-import wikipedia
+import hashlib
+import hmac
+import random
+import re
+import sqlite3
+import threading
+import queue
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+# PIL, duckduckgo_search, wikipedia, numpy, transformers and torch are imported where
+# they are first used, so a cold start only pays for the paths it takes
+
+# Seconds each retrieval source may take before it is dropped from the turn
+RETRIEVAL_DEADLINES = {
+    "search": float(os.getenv("SEARCH_DEADLINE", "4")),
+    "wikipedia": float(os.getenv("WIKIPEDIA_DEADLINE", "4"))
+}
+
+# Hugging Face inference API and connection pool settings
+HF_API_BASE = os.getenv("HF_API_BASE", "https://api-inference.huggingface.co/models")
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "4"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+CONNECT_TIMEOUT = float(os.getenv("HF_CONNECT_TIMEOUT", "5"))
+TEXT_READ_TIMEOUT = float(os.getenv("HF_TEXT_READ_TIMEOUT", "30"))
+IMAGE_READ_TIMEOUT = float(os.getenv("HF_IMAGE_READ_TIMEOUT", "30"))
+
+# Text models in order of preference (faster models first)
+TEXT_MODELS = [
+    "facebook/opt-350m",  # Fastest model
+    "gpt2",  # Quick response
+    "EleutherAI/gpt-neo-125M",  # Lightweight
+    "google/flan-t5-small"  # Efficient for short responses
+]
+# Seconds to wait for a good answer before also asking the next model
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "3"))
+# Total seconds a chat turn or image request may spend across all models and retries
+TURN_DEADLINE = float(os.getenv("TURN_DEADLINE", "45"))
+IMAGE_DEADLINE = float(os.getenv("IMAGE_DEADLINE", "90"))
+# Longest side and quality of the compressed preview shown on the page
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "512"))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "80"))
+# Seconds between progress refreshes while an image job is running
+IMAGE_POLL_INTERVAL = float(os.getenv("IMAGE_POLL_INTERVAL", "1"))
+# Longest the page keeps refreshing progress bars in place before a full rerun
+IMAGE_POLL_WINDOW = float(os.getenv("IMAGE_POLL_WINDOW", "60"))
+# Base delay for jittered exponential backoff, and statuses worth retrying
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1"))
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+# Context window of each text model, and tokens kept free for the answer
+MODEL_CONTEXT_TOKENS = {
+    "facebook/opt-350m": 2048,
+    "gpt2": 1024,
+    "EleutherAI/gpt-neo-125M": 2048,
+    "google/flan-t5-small": 512
+}
+RESPONSE_TOKENS = int(os.getenv("RESPONSE_TOKENS", "250"))
+# Add parameters for faster generation
+GENERATION_PARAMETERS = {
+    "max_new_tokens": RESPONSE_TOKENS,  # Limit response length
+    "num_return_sequences": 1,
+    "temperature": 0.7,  # Balance between creativity and speed
+    "top_p": 0.9,
+    "do_sample": True,
+    "return_full_text": False  # Reply with the continuation only, not the prompt echoed back
+}
+# Text generation backend: "api" for the Hugging Face inference API, "local" for CPU inference
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "api")
+LOCAL_MAX_BATCH_SIZE = int(os.getenv("LOCAL_MAX_BATCH_SIZE", "8"))
+LOCAL_MAX_BATCH_WAIT = float(os.getenv("LOCAL_MAX_BATCH_WAIT", "0.05"))
+# Stream tokens from the first model while the others stand by as hedges
+STREAMING_ENABLED = os.getenv("LUMO_STREAMING", "true").lower() == "true"
+
+# Image models in order of preference
+IMAGE_MODELS = [
+    "stabilityai/stable-diffusion-2-1",
+    "CompVis/stable-diffusion-v1-4",
+    "runwayml/stable-diffusion-v1-5"
+]
+
+# Circuit breaker settings for the model health tracker
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "300"))
+
+class ModelHealth:
+    """Per-model latency and error tracking with a circuit breaker.
+
+    Latency is tracked as an EWMA and a p95 over recent successes. After
+    failure_threshold consecutive failures a model's circuit opens and it is
+    skipped for cooldown seconds; the next attempt after that is a trial that
+    closes the circuit on success or reopens it on failure.
+    """
+
+    def __init__(self, failure_threshold, cooldown, alpha=0.3, window=50, latency_prior=5.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.window = window
+        self.latency_prior = latency_prior
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, model):
+        if model not in self.models:
+            self.models[model] = {
+                "ewma": None,
+                "latencies": deque(maxlen=self.window),
+                "outcomes": deque(maxlen=self.window),
+                "consecutive_failures": 0,
+                "loading": False,
+                "open_until": 0.0
+            }
+        return self.models[model]
+
+    def record_success(self, model, latency):
+        with self.lock:
+            entry = self._entry(model)
+            entry["ewma"] = latency if entry["ewma"] is None else self.alpha * latency + (1 - self.alpha) * entry["ewma"]
+            entry["latencies"].append(latency)
+            entry["outcomes"].append(True)
+            entry["consecutive_failures"] = 0
+            entry["loading"] = False
+            entry["open_until"] = 0.0
+
+    def record_failure(self, model, loading=False):
+        with self.lock:
+            entry = self._entry(model)
+            entry["outcomes"].append(False)
+            entry["consecutive_failures"] += 1
+            entry["loading"] = loading
+            if entry["consecutive_failures"] >= self.failure_threshold:
+                entry["open_until"] = time.time() + self.cooldown
+
+    def expected_latency(self, entry):
+        """Expected seconds until a good answer, penalizing models that often fail"""
+        latency = entry["ewma"] if entry["ewma"] is not None else self.latency_prior
+        outcomes = entry["outcomes"]
+        success_rate = sum(outcomes) / len(outcomes) if outcomes else 1.0
+        return latency / max(success_rate, 0.1)
+
+    def rank(self, models):
+        """Return models with closed circuits, fastest expected first.
+
+        If every circuit is open, all models are returned, soonest to recover first.
+        """
+        now = time.time()
+        with self.lock:
+            entries = {model: self._entry(model) for model in models}
+            available = [model for model in models if entries[model]["open_until"] <= now]
+            if not available:
+                return sorted(models, key=lambda model: entries[model]["open_until"])
+            # sorted is stable, so models without data keep their configured order
+            return sorted(available, key=lambda model: self.expected_latency(entries[model]))
+
+    def snapshot(self):
+        """Return one row of stats per model for display"""
+        now = time.time()
+        rows = []
+        with self.lock:
+            for model, entry in self.models.items():
+                latencies = sorted(entry["latencies"])
+                outcomes = entry["outcomes"]
+                rows.append({
+                    "model": model,
+                    "ewma_s": round(entry["ewma"], 2) if entry["ewma"] is not None else None,
+                    "p95_s": round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 2) if latencies else None,
+                    "error_rate": round(1 - sum(outcomes) / len(outcomes), 2) if outcomes else None,
+                    "loading": entry["loading"],
+                    "circuit": "open" if entry["open_until"] > now else "closed"
+                })
+        return rows
+
+@st.cache_resource(show_spinner=False)
+def get_model_health():
+    """Model health tracker shared by all sessions"""
+    return ModelHealth(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN, latency_prior=HEDGE_DELAY)
+
+# Process-wide request budget: requests per second (and burst) allowed per
+# Hugging Face token and per model, and how many requests may wait for one
+TOKEN_RATE = float(os.getenv("HF_TOKEN_RATE", "4"))
+TOKEN_BURST = int(os.getenv("HF_TOKEN_BURST", "8"))
+MODEL_RATE = float(os.getenv("HF_MODEL_RATE", "2"))
+MODEL_BURST = int(os.getenv("HF_MODEL_BURST", "4"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "32"))
+
+class AdmissionRejected(Exception):
+    """Raised when the request queue is full"""
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until one request may go out"""
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class AdmissionController:
+    """Rate limits Hugging Face requests across every session in the process.
+
+    Each request needs a free slot in the bucket for its token and the bucket
+    for its model. Requests whose buckets are both ready go out in round-robin
+    order across sessions: the session served least recently goes first, so
+    one busy session cannot starve the others. At most max_waiting requests
+    may wait; beyond that acquire raises AdmissionRejected straight away.
+    """
+
+    full_message = "The assistant is handling too many requests right now. Please try again in a moment."
+
+    def __init__(self, token_rate, token_burst, model_rate, model_burst, max_waiting, window=500):
+        self.token_rate = token_rate
+        self.token_burst = token_burst
+        self.model_rate = model_rate
+        self.model_burst = model_burst
+        self.max_waiting = max_waiting
+        self.buckets = {}
+        self.waiting = []
+        self.last_served = {}
+        self.waits = deque(maxlen=window)
+        self.admitted = 0
+        self.rejected = 0
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+    def _buckets(self, token, model):
+        # Tokens are keyed by a short hash so raw secrets never show up in stats
+        token_key = "token " + hashlib.sha256((token or "").encode()).hexdigest()[:8]
+        if token_key not in self.buckets:
+            self.buckets[token_key] = TokenBucket(self.token_rate, self.token_burst)
+        model_key = f"model {model}"
+        if model_key not in self.buckets:
+            self.buckets[model_key] = TokenBucket(self.model_rate, self.model_burst)
+        return self.buckets[token_key], self.buckets[model_key]
+
+    def check(self):
+        """Return a message if new requests would be rejected right now, else None"""
+        with self.condition:
+            if len(self.waiting) >= self.max_waiting:
+                return self.full_message
+        return None
+
+    def acquire(self, token, model, session_id, deadline=None, cancel_event=None):
+        """Wait for a request slot; returns seconds waited, or None on cancel or timeout"""
+        started = time.monotonic()
+        with self.condition:
+            if len(self.waiting) >= self.max_waiting:
+                self.rejected += 1
+                raise AdmissionRejected(self.full_message)
+            self.sequence += 1
+            ticket = {"session": session_id, "buckets": self._buckets(token, model), "sequence": self.sequence}
+            self.waiting.append(ticket)
+            try:
+                while True:
+                    if (cancel_event and cancel_event.is_set()) or (deadline and deadline.expired()):
+                        return None
+                    now = time.monotonic()
+                    ready = [
+                        waiter for waiter in self.waiting
+                        if all(bucket.wait_time(now) == 0 for bucket in waiter["buckets"])
+                    ]
+                    if ready and min(ready, key=self._turn_order) is ticket:
+                        for bucket in ticket["buckets"]:
+                            bucket.tokens -= 1
+                        self.last_served[session_id] = now
+                        self.admitted += 1
+                        waited = now - started
+                        self.waits.append(waited)
+                        return waited
+                    # Sleep until our buckets refill, or until another waiter is served
+                    timeout = max(bucket.wait_time(now) for bucket in ticket["buckets"]) or 0.05
+                    if deadline:
+                        timeout = min(timeout, deadline.remaining())
+                    if cancel_event:
+                        # Setting the event does not wake the condition, so check it regularly
+                        timeout = min(timeout, 0.1)
+                    self.condition.wait(max(timeout, 0.01))
+            finally:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+
+    def _turn_order(self, waiter):
+        return self.last_served.get(waiter["session"], 0.0), waiter["sequence"]
+
+    def stats(self):
+        """Return queue depth, wait percentiles and counters for display"""
+        with self.condition:
+            waits = sorted(self.waits)
+            return {
+                "waiting": len(self.waiting),
+                "queue_size": self.max_waiting,
+                "waiting_sessions": len({waiter["session"] for waiter in self.waiting}),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "p50_wait_s": round(waits[len(waits) // 2], 2) if waits else None,
+                "p95_wait_s": round(waits[min(len(waits) - 1, int(0.95 * len(waits)))], 2) if waits else None
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_admission():
+    """Request rate limiter shared by all sessions"""
+    return AdmissionController(TOKEN_RATE, TOKEN_BURST, MODEL_RATE, MODEL_BURST, ADMISSION_QUEUE_SIZE)
+
+# Wikipedia retrieval: "lean" fetches title, summary and URL in one API call,
+# "full" uses the wikipedia package and downloads the whole article
+WIKIPEDIA_MODE = os.getenv("WIKIPEDIA_MODE", "lean")
+WIKIPEDIA_API_URL = os.getenv("WIKIPEDIA_API_URL", "https://en.wikipedia.org/w/api.php")
+WIKIPEDIA_USER_AGENT = "Lumo.ai (https://github.com/subhan986/Lumo.ai)"
+# Optional JSON search endpoint used instead of DuckDuckGo, e.g. a local stand-in
+SEARCH_API_URL = os.getenv("SEARCH_API_URL")
+
+# Retrieval sources each prompt template reads; anything else is never fetched
+TEMPLATE_SOURCES = {
+    "essay": ("wikipedia",),
+    "story": ("search",),
+    "song": ("search",),
+    "general": ("wikipedia",)
+}
+
+# Retrieved text is split into passages of about PASSAGE_WORDS words and only
+# the PASSAGE_TOP_K best BM25 matches for the query reach the prompt
+PASSAGE_RANKING = os.getenv("LUMO_PASSAGE_RANKING", "true").lower() == "true"
+# Opt-in: ranks the whole Wikipedia article, which lean mode then fetches with a
+# second request after the summary
+RANK_WIKIPEDIA_PASSAGES = os.getenv("RANK_WIKIPEDIA_PASSAGES", "false").lower() == "true"
+PASSAGE_WORDS = int(os.getenv("PASSAGE_WORDS", "60"))
+PASSAGE_TOP_K = int(os.getenv("PASSAGE_TOP_K", "4"))
+
+# Per-stage latency metrics, appended as JSON lines and rotated by size
+METRICS_PATH = os.getenv("METRICS_PATH", "metrics.jsonl")
+METRICS_MAX_BYTES = int(float(os.getenv("METRICS_MAX_MB", "10")) * 1024 * 1024)
+
+# Messages rendered per chat before "load earlier", and chats per sidebar page
+MESSAGE_WINDOW = int(os.getenv("MESSAGE_WINDOW", "20"))
+CHATS_PER_PAGE = int(os.getenv("CHATS_PER_PAGE", "10"))
+
+# Visitors who do not sign in get a random id with this prefix. Their chats are
+# deleted GUEST_CHAT_TTL seconds after their last message, or moved to their
+# account if they sign in.
+GUEST_ID_PREFIX = "guest:"
+GUEST_CHAT_TTL = float(os.getenv("GUEST_CHAT_TTL", "86400"))
+# Wrong passwords allowed for a username before it refuses sign-ins for SIGN_IN_LOCKOUT seconds
+SIGN_IN_MAX_FAILURES = int(os.getenv("SIGN_IN_MAX_FAILURES", "5"))
+SIGN_IN_LOCKOUT = float(os.getenv("SIGN_IN_LOCKOUT", "300"))
+
+# Conversation context sent with each turn: the last CONTEXT_RECENT_MESSAGES
+# verbatim plus a rolling summary of older ones, within CONTEXT_TOKENS
+CONVERSATION_CONTEXT = os.getenv("LUMO_CONVERSATION_CONTEXT", "true").lower() == "true"
+CONTEXT_TOKENS = int(os.getenv("CONTEXT_TOKENS", "384"))
+CONTEXT_RECENT_MESSAGES = int(os.getenv("CONTEXT_RECENT_MESSAGES", "6"))
+SUMMARY_LINE_TOKENS = int(os.getenv("SUMMARY_LINE_TOKENS", "40"))
+
+# SQLite file shared by the on-disk caches
+DB_PATH = os.getenv("LUMO_DB_PATH", "users.db")
+
+class Trace:
+    """Timed spans for one chat turn or image job.
+
+    Spans can be added from any thread. Once the trace has been recorded,
+    late spans (for example from a dropped retrieval source) are ignored.
+    """
+
+    def __init__(self, kind):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.spans = []
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, **attributes):
+        with self.lock:
+            if not self.closed:
+                self.spans.append({"stage": stage, "ms": round(seconds * 1000, 1), **attributes})
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        """Time a block; the yielded dict can be filled with more attributes"""
+        started = time.monotonic()
+        try:
+            yield attributes
+        finally:
+            self.add(stage, time.monotonic() - started, **attributes)
+
+    def close(self):
+        """Stop accepting spans and return the trace as a dict"""
+        with self.lock:
+            self.closed = True
+            return {
+                "trace_id": self.id,
+                "kind": self.kind,
+                "started_at": self.started_at,
+                "total_ms": round((time.monotonic() - self.started) * 1000, 1),
+                "spans": list(self.spans)
+            }
+
+class MetricsLog:
+    """Appends finished traces to a size-rotated JSONL file and keeps latency summaries"""
+
+    def __init__(self, path, max_bytes, window=500):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.durations = {}
+        self.window = window
+        self.lock = threading.Lock()
+
+    def record(self, trace):
+        entry = trace.close()
+        with self.lock:
+            self._remember(f"{entry['kind']} total", entry["total_ms"])
+            for span in entry["spans"]:
+                stage = f"{span['stage']} ({span['model']})" if span.get("model") else span["stage"]
+                self._remember(stage, span["ms"])
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, f"{self.path}.1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+            except OSError:
+                pass
+        return entry
+
+    def _remember(self, stage, ms):
+        self.durations.setdefault(stage, deque(maxlen=self.window)).append(ms)
+
+    def summary(self):
+        """Return count, p50 and p95 in milliseconds for every stage seen"""
+        with self.lock:
+            rows = []
+            for stage, durations in sorted(self.durations.items()):
+                ordered = sorted(durations)
+                rows.append({
+                    "stage": stage,
+                    "count": len(ordered),
+                    "p50_ms": ordered[len(ordered) // 2],
+                    "p95_ms": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+                })
+            return rows
+
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    """Latency metrics log shared by all sessions"""
+    return MetricsLog(METRICS_PATH, METRICS_MAX_BYTES)
+
+class TieredCache:
+    """TTL cache with a size-bounded in-memory LRU backed by a SQLite table.
+
+    Every 100 writes the disk tier drops expired rows and, if max_disk_entries
+    is set, the entries closest to expiry once it grows past that size.
+    """
+
+    def __init__(self, db_path, table, ttl, max_entries, max_disk_entries=None):
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.writes = 0
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+            )
+            self.conn.execute(f"DELETE FROM {table} WHERE expires_at < ?", (time.time(),))
+
+    @staticmethod
+    def make_key(namespace, query):
+        """Normalize query text so trivially different queries share an entry"""
+        return f"{namespace}:{' '.join(query.lower().split())}"
+
+    def get(self, key):
+        """Return (found, value) for key, checking memory first and then disk"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return True, entry[1]
+            self.entries.pop(key, None)
+            
+            row = self.conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ? AND expires_at > ?",
+                (key, now)
+            ).fetchone()
+            if row:
+                value = json.loads(row[0])
+                self._remember(key, value, row[1])
+                self.stats["disk_hits"] += 1
+                return True, value
+            self.stats["misses"] += 1
+            return False, None
+
+    def set(self, key, value):
+        """Store value in both tiers"""
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self._remember(key, value, expires_at)
+            self.writes += 1
+            with self.conn:
+                self.conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), expires_at)
+                )
+                if self.writes % 100 == 0:
+                    self.conn.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (time.time(),))
+                if self.max_disk_entries and self.writes % 100 == 0:
+                    self.conn.execute(
+                        f"DELETE FROM {self.table} WHERE key IN "
+                        f"(SELECT key FROM {self.table} ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                        (self.max_disk_entries,)
+                    )
+
+    def _remember(self, key, value, expires_at):
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_or_fetch(self, namespace, query, fetch):
+        """Return the cached value for query, calling fetch() on a miss"""
+        key = self.make_key(namespace, query)
+        found, value = self.get(key)
+        if found:
+            return value
+        value = fetch()
+        self.set(key, value)
+        return value
+
+@st.cache_resource(show_spinner=False)
+def get_retrieval_cache():
+    """Retrieval cache shared by all sessions"""
+    return TieredCache(
+        DB_PATH,
+        "retrieval_cache",
+        ttl=float(os.getenv("RETRIEVAL_CACHE_TTL", "21600")),
+        max_entries=int(os.getenv("RETRIEVAL_CACHE_SIZE", "512")),
+        max_disk_entries=int(os.getenv("RETRIEVAL_CACHE_DISK_SIZE", "5000"))
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Generated-answer cache shared by all sessions"""
+    return TieredCache(
+        DB_PATH,
+        "response_cache",
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", "86400")),
+        max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "256")),
+        max_disk_entries=int(os.getenv("RESPONSE_CACHE_DISK_SIZE", "5000"))
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_summary_cache():
+    """Rolling conversation summaries, keyed by chat id"""
+    return TieredCache(
+        DB_PATH,
+        "chat_summaries",
+        ttl=float(os.getenv("SUMMARY_CACHE_TTL", "2592000")),
+        max_entries=int(os.getenv("SUMMARY_CACHE_SIZE", "256"))
+    )
+
+def chat_title(first_message):
+    """Short sidebar title for a chat, taken from its first message"""
+    title = " ".join(first_message.split())
+    return title if len(title) <= 40 else title[:39] + "…"
+
+class ChatStore:
+    """Durable chat history in SQLite.
+
+    Messages are append-only rows indexed by chat and time, and the database runs
+    in WAL mode so readers never wait on writers. Recently opened chats stay in
+    a small in-memory LRU; everything else is loaded from disk when selected.
+    Chat titles are computed once, from the first user message, and stored.
+    Guest chats idle for guest_ttl seconds are deleted at startup and every
+    100 messages.
+    """
+
+    def __init__(self, db_path, max_cached_chats, guest_ttl):
+        self.max_cached_chats = max_cached_chats
+        self.guest_ttl = guest_ttl
+        self.cached = OrderedDict()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chats "
+                "(chat_id TEXT PRIMARY KEY, user_id TEXT, title TEXT, created_date TEXT, updated_at REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT NOT NULL, role TEXT NOT NULL, "
+                "content TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._migrate()
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_time ON messages (chat_id, created_at)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_user_updated ON chats (user_id, updated_at)")
+            self._purge_guest_chats()
+
+    def _migrate(self):
+        # Older databases have chats without updated_at or titles
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(chats)")]
+        if "updated_at" not in columns:
+            self.conn.execute("ALTER TABLE chats ADD COLUMN updated_at REAL")
+            self.conn.execute(
+                "UPDATE chats SET updated_at = "
+                "(SELECT MAX(created_at) FROM messages WHERE messages.chat_id = chats.chat_id)"
+            )
+        untitled = self.conn.execute(
+            "SELECT chats.chat_id, (SELECT content FROM messages WHERE messages.chat_id = chats.chat_id "
+            "AND role = 'user' ORDER BY created_at, id LIMIT 1) FROM chats WHERE title IS NULL"
+        ).fetchall()
+        for chat_id, first_message in untitled:
+            if first_message:
+                self.conn.execute("UPDATE chats SET title = ? WHERE chat_id = ?", (chat_title(first_message), chat_id))
+
+    def append_message(self, chat_id, user_id, role, content):
+        """Add one message to a chat, creating the chat on its first message"""
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO chats (chat_id, user_id, title, created_date, updated_at) "
+                    "VALUES (?, ?, NULL, datetime('now'), ?)",
+                    (chat_id, user_id, now)
+                )
+                self.conn.execute(
+                    "INSERT INTO messages (chat_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                    (chat_id, role, content, now)
+                )
+                self.conn.execute("UPDATE chats SET updated_at = ? WHERE chat_id = ?", (now, chat_id))
+                if role == "user":
+                    self.conn.execute(
+                        "UPDATE chats SET title = ? WHERE chat_id = ? AND title IS NULL",
+                        (chat_title(content), chat_id)
+                    )
+                self.writes += 1
+                if self.writes % 100 == 0:
+                    self._purge_guest_chats()
+            if chat_id in self.cached:
+                self.cached[chat_id].append({"role": role, "content": content})
+
+    def _purge_guest_chats(self):
+        expired = [
+            row[0] for row in self.conn.execute(
+                "SELECT chat_id FROM chats WHERE user_id LIKE ? AND updated_at < ?",
+                (f"{GUEST_ID_PREFIX}%", time.time() - self.guest_ttl)
+            )
+        ]
+        for chat_id in expired:
+            self.conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+            self.conn.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+            self.cached.pop(chat_id, None)
+
+    def move_chats(self, from_user_id, to_user_id):
+        """Give every chat of one user to another, e.g. a guest's chats to their new account"""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE chats SET user_id = ? WHERE user_id = ?", (to_user_id, from_user_id))
+
+    def load_messages(self, chat_id):
+        """Return a copy of a chat's messages in order"""
+        with self.lock:
+            if chat_id in self.cached:
+                self.cached.move_to_end(chat_id)
+            else:
+                rows = self.conn.execute(
+                    "SELECT role, content FROM messages WHERE chat_id = ? ORDER BY created_at, id",
+                    (chat_id,)
+                ).fetchall()
+                self.cached[chat_id] = [{"role": role, "content": content} for role, content in rows]
+                # Evict the chats nobody has opened for the longest
+                while len(self.cached) > self.max_cached_chats:
+                    self.cached.popitem(last=False)
+            return list(self.cached[chat_id])
+
+    def list_chats(self, user_id, search="", limit=None, offset=0):
+        """Return (chats, total) for one page of a user's chats, most recently active first.
+
+        chats is a list of (chat_id, title); search matches titles.
+        """
+        where = "user_id = ?"
+        params = [user_id]
+        if search:
+            where += " AND title LIKE ? ESCAPE '\\'"
+            escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+        with self.lock:
+            total = self.conn.execute(f"SELECT COUNT(*) FROM chats WHERE {where}", params).fetchone()[0]
+            chats = self.conn.execute(
+                f"SELECT chat_id, title FROM chats WHERE {where} ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+                params + [limit if limit is not None else -1, offset]
+            ).fetchall()
+        return chats, total
+
+@st.cache_resource(show_spinner=False)
+def get_chat_store():
+    """Chat history store shared by all sessions"""
+    return ChatStore(DB_PATH, max_cached_chats=int(os.getenv("CHAT_CACHE_SIZE", "64")), guest_ttl=GUEST_CHAT_TTL)
+
+class UserStore:
+    """Accounts in the users table of the chat database.
+
+    Passwords are stored as salted PBKDF2 hashes. Accounts from older versions
+    hold an unsalted SHA-256 hex digest; those still verify and are rehashed on
+    their next sign-in. After max_failures wrong passwords for a username,
+    whether or not it exists, sign-ins for it are refused until lockout seconds
+    have passed since the last one. Failure counts are kept in memory.
+    """
+
+    iterations = 200_000
+
+    def __init__(self, db_path, max_failures, lockout):
+        self.max_failures = max_failures
+        self.lockout = lockout
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS users "
+                "(username TEXT PRIMARY KEY, password TEXT, created_date TEXT)"
+            )
+
+    def hash_password(self, password, salt=None, iterations=None):
+        salt = salt or os.urandom(16).hex()
+        iterations = iterations or self.iterations
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), iterations).hex()
+        return f"pbkdf2_sha256${iterations}${salt}${digest}"
+
+    def create(self, username, password):
+        """Add an account; returns None, or the reason it could not be created"""
+        if not re.fullmatch(r"[\w.-]{1,40}", username):
+            return "Usernames must be 1 to 40 letters, digits, dots, dashes or underscores."
+        if len(password) < 8:
+            return "Passwords must be at least 8 characters."
+        with self.lock, self.conn:
+            try:
+                self.conn.execute(
+                    "INSERT INTO users (username, password, created_date) VALUES (?, ?, ?)",
+                    (username, self.hash_password(password), time.strftime("%Y-%m-%d %H:%M:%S"))
+                )
+            except sqlite3.IntegrityError:
+                return "That username is taken."
+        return None
+
+    def locked_for(self, username):
+        """Seconds until a username may try to sign in again, or 0"""
+        with self.lock:
+            count, last_failed = self.failures.get(username, (0, 0.0))
+        if count < self.max_failures:
+            return 0.0
+        return max(0.0, last_failed + self.lockout - time.time())
+
+    def verify(self, username, password):
+        """Check a username and password, counting failures towards a lockout"""
+        if self.locked_for(username):
+            return False
+        verified = self._check(username, password)
+        now = time.time()
+        with self.lock:
+            if verified:
+                self.failures.pop(username, None)
+            else:
+                # Forget failures older than the lockout, so the table stays small
+                self.failures = {
+                    name: failure for name, failure in self.failures.items()
+                    if now - failure[1] < self.lockout
+                }
+                count = self.failures.get(username, (0, 0.0))[0]
+                self.failures[username] = (count + 1, now)
+        return verified
+
+    def _check(self, username, password):
+        with self.lock:
+            row = self.conn.execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        if not row or not row[0]:
+            return False
+        stored = row[0]
+        if stored.startswith("pbkdf2_sha256$"):
+            _, iterations, salt, _ = stored.split("$")
+            return hmac.compare_digest(self.hash_password(password, salt, int(iterations)), stored)
+        if not hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored):
+            return False
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE users SET password = ? WHERE username = ?", (self.hash_password(password), username))
+        return True
+
+@st.cache_resource(show_spinner=False)
+def get_user_store():
+    """Account store shared by all sessions"""
+    return UserStore(DB_PATH, SIGN_IN_MAX_FAILURES, SIGN_IN_LOCKOUT)
+
+def response_fingerprint(turn_inputs, backend):
+    """Content address of an answer: the same inputs always map to the same key.
+
+    turn_inputs holds what every model's prompt is built from, so one lookup
+    covers all models without building their prompts first.
+    """
+    material = json.dumps({
+        "inputs": turn_inputs,
+        "models": TEXT_MODELS,
+        "parameters": GENERATION_PARAMETERS,
+        "backend": backend
+    }, sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    """Keep-alive HTTP session shared by the text and image paths"""
+    session = requests.Session()
+    # pool_maxsize caps the keep-alive connections kept per host. Requests beyond it
+    # open a short-lived connection rather than waiting for one, since a wait for the
+    # pool would not be bounded by the connect timeout or the turn deadline
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE, pool_block=False)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def hf_model_url(model):
+    """Return the inference endpoint for a Hugging Face model"""
+    return f"{HF_API_BASE}/{model}"
+
+class Services:
+    """Process-wide objects used by code running on worker threads.
+
+    The st.cache_resource getters need the script thread's ScriptRunContext,
+    so the script resolves them here and passes the bundle to its workers.
+    """
+
+    def __init__(self):
+        self.http = get_http_session()
+        self.health = get_model_health()
+        self.admission = get_admission()
+        self.metrics = get_metrics()
+        self.retrieval_cache = get_retrieval_cache()
+        self.image_store = get_image_store()
 
 # Helper functions
-def get_wikipedia_content(topic):
-    """Fetch content from Wikipedia"""
-    try:
-        # Search for the topic
-        search_results = wikipedia.search(topic)
-        if not search_results:
-            return None
+def retrieval_timeout(deadline):
+    """(connect, read) timeout that ends a retrieval request by its deadline"""
+    if deadline.expired():
+        raise requests.exceptions.Timeout("Lookup ran out of time before it started")
+    remaining = deadline.remaining()
+    return min(CONNECT_TIMEOUT, remaining), remaining
+
+def wikipedia_api_get(params, services, deadline):
+    """Call the MediaWiki API through the shared HTTP session"""
+    response = services.http.get(
+        WIKIPEDIA_API_URL,
+        params={"action": "query", "format": "json", "formatversion": "2", **params},
+        headers={"User-Agent": WIKIPEDIA_USER_AGENT},
+        timeout=retrieval_timeout(deadline)
+    )
+    response.raise_for_status()
+    return response.json()
+
+def fetch_wikipedia_summary(topic, services, deadline):
+    """Fetch title, intro summary and URL of the best match in a single request"""
+    data = wikipedia_api_get({
+        "generator": "search",
+        "gsrsearch": topic,
+        "gsrlimit": 3,
+        "prop": "extracts|info|pageprops",
+        "exintro": 1,
+        "explaintext": 1,
+        "inprop": "url",
+        "ppprop": "disambiguation",
+        "redirects": 1
+    }, services, deadline)
+    pages = sorted(data.get("query", {}).get("pages", []), key=lambda page: page.get("index", 0))
+    # Skip disambiguation pages, which have no useful summary
+    pages = [page for page in pages if "disambiguation" not in page.get("pageprops", {})]
+    if not pages:
+        return None
+    page = pages[0]
+    return {
+        "title": page["title"],
+        "summary": page.get("extract", ""),
+        "url": page.get("fullurl", "")
+    }
+
+def fetch_wikipedia_page(topic):
+    """Fetch a whole article, including its content, with the wikipedia package"""
+    import wikipedia
+    
+    # Search for the topic
+    search_results = wikipedia.search(topic)
+    if not search_results:
+        return None
+    
+    # Get the first result
+    page = wikipedia.page(search_results[0])
+    
+    # Get the summary
+    summary = page.summary
+    
+    # Get the main content
+    content = page.content
+    
+    return {
+        "title": page.title,
+        "summary": summary,
+        "content": content,
+        "url": page.url
+    }
+
+def get_wikipedia_content(topic, services=None, deadline=None):
+    """Fetch content from Wikipedia, giving up on requests once deadline passes"""
+    services = services or Services()
+    deadline = deadline or Deadline(RETRIEVAL_DEADLINES["wikipedia"])
+    cache = services.retrieval_cache
+    if WIKIPEDIA_MODE == "full":
+        return cache.get_or_fetch("wikipedia", topic, lambda: fetch_wikipedia_page(topic))
+    wiki_content = cache.get_or_fetch("wikipedia-summary", topic, lambda: fetch_wikipedia_summary(topic, services, deadline))
+    if wiki_content and PASSAGE_RANKING and RANK_WIKIPEDIA_PASSAGES:
+        # Passage ranking picks the relevant parts of the whole article
+        try:
+            wiki_content = dict(wiki_content, content=get_wikipedia_article_text(wiki_content["title"], services, deadline))
+        except requests.exceptions.RequestException:
+            pass
+    return wiki_content
+
+def get_wikipedia_article_text(title, services, deadline):
+    """Fetch the plain text of a whole article, with "== Heading ==" section lines"""
+    def fetch():
+        data = wikipedia_api_get({
+            "titles": title,
+            "prop": "extracts",
+            "explaintext": 1,
+            "exsectionformat": "wiki",
+            "redirects": 1
+        }, services, deadline)
+        pages = data.get("query", {}).get("pages", [])
+        return pages[0].get("extract", "") if pages else ""
+    
+    return services.retrieval_cache.get_or_fetch("wikipedia-text", title, fetch)
+
+def classify_intent(user_query):
+    """Pick the prompt template create_assistant_prompt will use for a query"""
+    query = user_query.lower()
+    if "essay" in query or "write about" in query:
+        return "essay"
+    if "story" in query:
+        return "story"
+    if "song" in query:
+        return "song"
+    return "general"
+
+def get_wikipedia_topic(user_query):
+    """Return the topic create_assistant_prompt looks up on Wikipedia"""
+    if classify_intent(user_query) == "essay":
+        return user_query.lower().replace("write essay on", "").replace("essay on", "").replace("write about", "").strip()
+    return user_query
+
+def plan_retrieval(user_query):
+    """Build the lookups needed by the query's prompt template.
+
+    Returns (intent, lookups, skipped) where lookups is ready for run_retrieval
+    and skipped lists the sources the template would never read.
+    """
+    intent = classify_intent(user_query)
+    lookups = {}
+    skipped = []
+    for source in ("search", "wikipedia"):
+        if source not in TEMPLATE_SOURCES[intent]:
+            skipped.append(source)
+        elif source == "search":
+            if should_use_web_search(user_query):
+                lookups["search"] = (search_web, user_query)
+            else:
+                skipped.append(source)
+        else:
+            lookups["wikipedia"] = (get_wikipedia_content, get_wikipedia_topic(user_query))
+    return intent, lookups, skipped
+
+@st.cache_resource
+def get_retrieval_pool():
+    """Thread pool shared by all sessions for retrieval lookups"""
+    return ThreadPoolExecutor(max_workers=int(os.getenv("RETRIEVAL_WORKERS", "8")), thread_name_prefix="lumo-retrieval")
+
+def run_retrieval(lookups, trace=None):
+    """Run retrieval lookups concurrently, dropping sources that miss their deadline.
+
+    lookups maps a source name to (function, *args); each function is also
+    passed services= and its source's Deadline as deadline=, which it uses as
+    its request timeout so a dropped lookup frees its worker on time rather
+    than holding a pool slot. Returns a dict of results (None for failed or
+    dropped sources) and a list of error messages.
+    """
+    services = Services()
+    def timed(fn, *args, deadline):
+        started = time.monotonic()
+        return fn(*args, services=services, deadline=deadline), time.monotonic() - started
+    
+    pool = get_retrieval_pool()
+    start = time.monotonic()
+    futures = {
+        name: pool.submit(timed, fn, *args, deadline=Deadline(RETRIEVAL_DEADLINES.get(name, 4)))
+        for name, (fn, *args) in lookups.items()
+    }
+    
+    results = {}
+    errors = []
+    for name, future in futures.items():
+        deadline = RETRIEVAL_DEADLINES.get(name, 4)
+        remaining = deadline - (time.monotonic() - start)
+        try:
+            results[name], seconds = future.result(timeout=max(remaining, 0))
+            if trace:
+                trace.add(f"retrieval:{name}", seconds, status="ok")
+        except FutureTimeoutError:
+            future.cancel()
+            results[name] = None
+            errors.append(f"{name.capitalize()} lookup took too long and was skipped")
+            if trace:
+                trace.add(f"retrieval:{name}", deadline, status="dropped")
+        except Exception as e:
+            results[name] = None
+            errors.append(f"{name.capitalize()} error: {str(e)}")
+            if trace:
+                trace.add(f"retrieval:{name}", time.monotonic() - start, status="error")
+    return results, errors
+
+def split_passages(text, max_words=PASSAGE_WORDS):
+    """Split text into passages of whole sentences, each about max_words long"""
+    passages = []
+    for paragraph in re.split(r"\n+", text):
+        # Skip "== Heading ==" lines from full articles
+        paragraph = paragraph.strip()
+        if not paragraph or re.fullmatch(r"=+ .* =+", paragraph):
+            continue
+        current = []
+        length = 0
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            words = len(sentence.split())
+            if current and length + words > max_words:
+                passages.append(" ".join(current))
+                current, length = [], 0
+            current.append(sentence)
+            length += words
+        if current:
+            passages.append(" ".join(current))
+    return passages
+
+def index_terms(text):
+    return re.findall(r"\w+", text.lower())
+
+class PassageIndex:
+    """BM25 index over passages, grown one source at a time.
+
+    Adding a source only tokenizes that source's passages; its postings are
+    appended as (passage, term, count) arrays. Scoring a query is vectorized
+    with NumPy over the postings of the query's terms.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        self.passages = []
+        self.lengths = []
+        self.postings = []
+
+    def add_source(self, source, passages):
+        import numpy as np
         
-        # Get the first result
-        page = wikipedia.page(search_results[0])
+        passage_ids, term_ids, counts = [], [], []
+        for position, passage in enumerate(passages):
+            terms = index_terms(passage)
+            passage_id = len(self.passages)
+            self.passages.append((source, position, passage))
+            self.lengths.append(len(terms))
+            term_counts = {}
+            for term in terms:
+                term_id = self.vocabulary.setdefault(term, len(self.vocabulary))
+                term_counts[term_id] = term_counts.get(term_id, 0) + 1
+            passage_ids.extend([passage_id] * len(term_counts))
+            term_ids.extend(term_counts)
+            counts.extend(term_counts.values())
+        self.postings.append((np.array(passage_ids, dtype=np.int64), np.array(term_ids, dtype=np.int64), np.array(counts, dtype=np.float64)))
+
+    def scores(self, query):
+        """BM25 score of every passage for query, in the order they were added"""
+        import numpy as np
         
-        # Get the summary
-        summary = page.summary
+        total = len(self.passages)
+        query_ids = [self.vocabulary[term] for term in set(index_terms(query)) if term in self.vocabulary]
+        if not total or not query_ids:
+            return np.zeros(total)
+        passage_ids = np.concatenate([postings[0] for postings in self.postings])
+        term_ids = np.concatenate([postings[1] for postings in self.postings])
+        counts = np.concatenate([postings[2] for postings in self.postings])
+        lengths = np.array(self.lengths, dtype=np.float64)
+        # Each passage lists a term once, so a term's document frequency is its posting count
+        document_frequency = np.bincount(term_ids, minlength=len(self.vocabulary))
         
-        # Get the main content
-        content = page.content
+        matches = np.isin(term_ids, query_ids)
+        passage_ids, term_ids, counts = passage_ids[matches], term_ids[matches], counts[matches]
+        df = document_frequency[term_ids]
+        idf = np.log(1 + (total - df + 0.5) / (df + 0.5))
+        length_norm = 1 - self.b + self.b * lengths[passage_ids] / max(lengths.mean(), 1.0)
+        weights = idf * counts * (self.k1 + 1) / (counts + self.k1 * length_norm)
+        return np.bincount(passage_ids, weights=weights, minlength=total)
+
+    def top(self, query, k):
+        """Return up to k (source, position, passage) tuples, best match first"""
+        import numpy as np
         
-        return {
-            "title": page.title,
-            "summary": summary,
-            "content": content,
-            "url": page.url
-        }
-    except Exception as e:
-        st.error(f"Error fetching from Wikipedia: {str(e)}")
+        # A stable sort keeps source order among equally scored passages
+        order = np.argsort(-self.scores(query), kind="stable")[:k]
+        return [self.passages[index] for index in order]
+
+def rank_passages(retrieved, user_query, top_k=PASSAGE_TOP_K):
+    """Cut retrieved sources down to their top_k passages for the query.
+
+    Search results become one result per kept passage, best first. With
+    RANK_WIKIPEDIA_PASSAGES, the Wikipedia summary is replaced by the kept
+    passages of the full article (get_wikipedia_content fetches it in that
+    case), in article order.
+    """
+    index = PassageIndex()
+    search_results = retrieved.get("search") or []
+    for number, result in enumerate(search_results):
+        index.add_source(("search", number), split_passages(result.get("body", "")))
+    wiki_content = retrieved.get("wikipedia")
+    if wiki_content and RANK_WIKIPEDIA_PASSAGES:
+        index.add_source(("wikipedia", 0), split_passages(wiki_content.get("content") or wiki_content["summary"]))
+    
+    top = index.top(user_query, top_k)
+    ranked = dict(retrieved)
+    if search_results:
+        ranked["search"] = [
+            dict(search_results[number], body=passage)
+            for (source, number), _, passage in top if source == "search"
+        ]
+    if wiki_content and RANK_WIKIPEDIA_PASSAGES:
+        kept = sorted((position, passage) for (source, _), position, passage in top if source == "wikipedia")
+        if kept:
+            ranked["wikipedia"] = dict(wiki_content, summary=" ".join(passage for _, passage in kept))
+    return ranked
+
+@st.cache_resource(show_spinner=False)
+def get_tokenizer(model):
+    """Load a model's tokenizer once per process; None if it is unavailable"""
+    if model is None:
+        return None
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(model)
+    except Exception:
         return None
 
-def create_assistant_prompt(user_query, search_results=None):
-    """Create a well-structured prompt for GPT-like responses"""
-    if "essay" in user_query.lower() or "write about" in user_query.lower():
-        # Extract the topic from the query
-        topic = user_query.lower().replace("write essay on", "").replace("essay on", "").replace("write about", "").strip()
-        
-        # Get Wikipedia content
-        wiki_content = get_wikipedia_content(topic)
-        
-        if wiki_content:
-            return f"""Based on Wikipedia information about {topic}, provide a comprehensive overview. Include:
+def count_tokens(text, model):
+    """Count tokens with the model's tokenizer, estimating when it is unavailable"""
+    tokenizer = get_tokenizer(model)
+    if tokenizer is None:
+        return len(text) // 4 + 1  # Roughly four characters per token in English
+    return len(tokenizer.encode(text, add_special_tokens=False))
 
-1. Introduction: {wiki_content['summary']}
+def truncate_to_tokens(text, max_tokens, model):
+    """Cut text down to max_tokens, preferring to end on a sentence"""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    tokenizer = get_tokenizer(model)
+    if tokenizer is None:
+        cut = text[:max_tokens * 4]
+    else:
+        cut = tokenizer.decode(tokenizer.encode(text, add_special_tokens=False)[:max_tokens])
+    sentence_end = cut.rfind(". ")
+    return cut[:sentence_end + 1] if sentence_end > 0 else cut
+
+def prompt_token_budget(model):
+    """Tokens a prompt may use while leaving room for the answer"""
+    return MODEL_CONTEXT_TOKENS.get(model, 1024) - RESPONSE_TOKENS
+
+def pack_context(snippets, user_query, max_tokens, model):
+    """Deduplicate and rank snippets, keeping the best ones that fit in max_tokens"""
+    unique = []
+    seen_words = []
+    for snippet in snippets:
+        words = set(snippet.lower().split())
+        if not words:
+            continue
+        # Drop snippets that mostly repeat one already kept
+        if any(len(words & other) / len(words | other) > 0.7 for other in seen_words):
+            continue
+        unique.append(snippet)
+        seen_words.append(words)
+    
+    index = PassageIndex()
+    index.add_source("snippets", unique)
+    ranked = [snippet for _, _, snippet in index.top(user_query, len(unique))]
+    packed = []
+    used = 0
+    for snippet in ranked:
+        tokens = count_tokens(snippet, model)
+        if max_tokens is not None and used + tokens > max_tokens:
+            continue
+        packed.append(snippet)
+        used += tokens
+    return packed
+
+def wikipedia_prompt(subject, wiki_content, model=None, reserved_tokens=0):
+    """Build the Wikipedia-based overview prompt, trimming the summary to the model's budget"""
+    template = """Based on Wikipedia information about {subject}, provide a comprehensive overview. Include:
+
+1. Introduction: {summary}
 
 2. Main Content: Present the key information from the Wikipedia article in a clear, organized manner.
 
 3. Additional Details: Include relevant facts and explanations from the article.
 
-Source: {wiki_content['url']}"""
+Source: {url}"""
+    summary = wiki_content['summary']
+    if model:
+        overhead = count_tokens(template.format(subject=subject, summary="", url=wiki_content['url']), model)
+        summary = truncate_to_tokens(summary, prompt_token_budget(model) - reserved_tokens - overhead, model)
+    return template.format(subject=subject, summary=summary, url=wiki_content['url'])
+
+def create_assistant_prompt(user_query, search_results=None, wiki_content=None, model=None, conversation=""):
+    """Create a well-structured prompt for GPT-like responses.
+
+    When model is given, retrieved context is packed to fit its token budget.
+    conversation, from conversation_context, goes ahead of the request and its
+    tokens come out of the budget left for retrieved context.
+    """
+    reserved_tokens = count_tokens(conversation, model) if conversation and model else 0
+    prompt = task_prompt(user_query, search_results, wiki_content, model, reserved_tokens)
+    if conversation:
+        return f"{conversation}\n\nCurrent request:\n{prompt}"
+    return prompt
+
+def task_prompt(user_query, search_results=None, wiki_content=None, model=None, reserved_tokens=0):
+    """Build the prompt for the request itself from its intent and retrieved context"""
+    intent = classify_intent(user_query)
+    if intent == "essay":
+        # Extract the topic from the query
+        topic = get_wikipedia_topic(user_query)
+        
+        if wiki_content:
+            return wikipedia_prompt(topic, wiki_content, model, reserved_tokens)
         else:
             return f"""Please provide a detailed and informative response about:
 {user_query}
 
 Include relevant facts and explanations."""
-    elif "story" in user_query.lower():
+    elif intent == "story":
         base_prompt = """Create an engaging story about:
 {query}
 
 Make it creative and entertaining with a clear plot."""
-    elif "song" in user_query.lower():
+    elif intent == "song":
         base_prompt = """Write song lyrics about:
 {query}
 
 Include verses and a chorus."""
     else:
-        # For general queries, try to get Wikipedia content first
-        wiki_content = get_wikipedia_content(user_query)
+        # For general queries, use Wikipedia content when available
         if wiki_content:
-            return f"""Based on Wikipedia information about {user_query}, provide a comprehensive overview. Include:
-
-1. Introduction: {wiki_content['summary']}
-
-2. Main Content: Present the key information from the Wikipedia article in a clear, organized manner.
-
-3. Additional Details: Include relevant facts and explanations from the article.
-
-Source: {wiki_content['url']}"""
+            return wikipedia_prompt(user_query, wiki_content, model, reserved_tokens)
         else:
             return f"""Please provide a detailed and informative response about:
 {user_query}
 
 Include relevant facts and explanations."""
     
+    base_prompt = base_prompt.format(query=user_query)
     if search_results:
-        context = "\n".join([
-            f"Reference Information:\n{result['body']}\n"
-            for i, result in enumerate(search_results)
-        ])
-        base_prompt += f"""
+        instructions = """
 
 Using the following reference information, create your response:
 {context}
 
 Please write a well-structured response incorporating this information:"""
+        max_tokens = None
+        if model:
+            max_tokens = prompt_token_budget(model) - reserved_tokens - count_tokens(base_prompt + instructions.format(context=""), model)
+        snippets = pack_context([result['body'] for result in search_results], user_query, max_tokens, model)
+        if snippets:
+            context = "\n".join([
+                f"Reference Information:\n{snippet}\n"
+                for snippet in snippets
+            ])
+            base_prompt += instructions.format(context=context)
     
-    return base_prompt.format(query=user_query)
+    return base_prompt
+
+def speaker(message):
+    return "User" if message["role"] == "user" else "Assistant"
+
+def summarize_message(message):
+    """Compress a message to one summary line: who spoke and their opening sentence"""
+    text = " ".join(message["content"].split())
+    sentence_end = text.find(". ")
+    if sentence_end > 0:
+        text = text[:sentence_end + 1]
+    # The summary is shared by every model, so its size is estimated, not tokenized
+    return f"{speaker(message)}: {truncate_to_tokens(text, SUMMARY_LINE_TOKENS, None)}"
+
+def update_conversation_summary(chat_id, history):
+    """Fold messages that left the recent window into the chat's cached summary.
+
+    Only messages evicted since the last turn are summarized. Once the summary
+    outgrows half of CONTEXT_TOKENS its oldest lines are dropped, so it stays
+    the same size however long the chat gets. Returns the summary lines.
+    """
+    older = history[:max(0, len(history) - CONTEXT_RECENT_MESSAGES)]
+    cache = get_summary_cache()
+    found, state = cache.get(chat_id)
+    if not found or state["summarized"] > len(older):
+        state = {"summarized": 0, "lines": []}
+    if state["summarized"] < len(older):
+        lines = state["lines"] + [summarize_message(message) for message in older[state["summarized"]:]]
+        while lines and count_tokens("\n".join(lines), None) > CONTEXT_TOKENS // 2:
+            lines.pop(0)
+        state = {"summarized": len(older), "lines": lines}
+        cache.set(chat_id, state)
+    return state["lines"]
+
+def conversation_context(summary_lines, recent, model):
+    """Render the summary and recent messages within the model's share of CONTEXT_TOKENS.
+
+    The newest messages are kept first, then as much of the newest end of the
+    summary as still fits. Returns "" when there is nothing to include.
+    """
+    summary_heading = "Earlier in this conversation:"
+    recent_heading = "Recent messages:"
+    budget = min(CONTEXT_TOKENS, prompt_token_budget(model) // 2)
+    budget -= count_tokens(f"{summary_heading}\n{recent_heading}\n", model)
+    recent_lines = []
+    for message in reversed(recent):
+        line = f"{speaker(message)}: {' '.join(message['content'].split())}"
+        if count_tokens(line, model) > budget:
+            line = truncate_to_tokens(line, budget, model)
+        if not line:
+            break
+        recent_lines.insert(0, line)
+        budget -= count_tokens(line, model)
+    kept_summary = []
+    for line in reversed(summary_lines):
+        tokens = count_tokens(line, model)
+        if tokens > budget:
+            break
+        kept_summary.insert(0, line)
+        budget -= tokens
+    
+    parts = []
+    if kept_summary:
+        parts.append(summary_heading + "\n" + "\n".join(kept_summary))
+    if recent_lines:
+        parts.append(recent_heading + "\n" + "\n".join(recent_lines))
+    return "\n\n".join(parts)
+
+GREETINGS = frozenset(['hi', 'hello', 'hey', 'greetings', 'good morning', 'good afternoon', 'good evening', 'hi there'])
+GREETING_RESPONSES = (
+    "Hello! How can I help you today? 😊",
+    "Hi there! I'm here to assist you. What's on your mind?",
+    "Hey! Great to see you. What would you like to know?",
+    "Greetings! I'm ready to help you with any questions.",
+    "Hello! I'm your AI assistant. How may I help you today?"
+)
 
 def is_greeting(text):
     """Check if the input is a greeting"""
-    greetings = ['hi', 'hello', 'hey', 'greetings', 'good morning', 'good afternoon', 'good evening', 'hi there']
-    return text.lower().strip() in greetings
+    return text.lower().strip() in GREETINGS
 
 def get_greeting_response():
     """Return a friendly greeting response"""
-    import random
-    responses = [
-        "Hello! How can I help you today? 😊",
-        "Hi there! I'm here to assist you. What's on your mind?",
-        "Hey! Great to see you. What would you like to know?",
-        "Greetings! I'm ready to help you with any questions.",
-        "Hello! I'm your AI assistant. How may I help you today?"
-    ]
-    return random.choice(responses)
+    return random.choice(GREETING_RESPONSES)
 
 def should_use_web_search(text):
     """Determine if web search is needed"""
@@ -134,69 +1402,913 @@ def should_use_web_search(text):
     # Search for essays, factual queries, and explanations
     return True
 
-def make_api_request(url, payload, max_retries=3):
-    """Make API request with retries"""
-    headers = {"Authorization": f"Bearer {st.session_state.hf_token}"}
+class Deadline:
+    """Time budget shared by every model and retry in one turn"""
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+def parse_response_body(response):
+    """Parse a JSON response body once; returns None for other content types"""
+    if "json" not in response.headers.get("content-type", ""):
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+def is_model_loading(response, body):
+    """Check for the "Model is loading" answer HF gives while a model warms up"""
+    if not isinstance(body, dict):
+        return False
+    return response.status_code in (200, 503) and "loading" in str(body.get("error", "")).lower()
+
+def retry_delay(attempt, response=None, body=None):
+    """Seconds to wait before retrying, preferring the server's own hints"""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    if isinstance(body, dict) and body.get("estimated_time"):
+        return float(body["estimated_time"])
+    # Full jitter keeps concurrent sessions from retrying in lockstep
+    return random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt)
+
+def wait_before_retry(delay, deadline, cancel_event):
+    """Wait delay seconds unless that would overrun the deadline or the request is cancelled.
+
+    Returns True if the caller should retry.
+    """
+    if delay >= deadline.remaining():
+        return False
+    return not cancel_event.wait(delay)
+
+def make_api_request(url, payload, max_retries=3, read_timeout=TEXT_READ_TIMEOUT, token=None, cancel_event=None, model=None, deadline=None, trace=None, session_id=None, services=None):
+    """Make API request with retries.
+
+    Returns (response, body), where body is the parsed JSON or None for other
+    content types, or (None, None) if the request was cancelled or ran out of
+    time. Retries use jittered backoff or the server's Retry-After/estimated_time
+    hint, and never wait past deadline. Every attempt first waits for the
+    process-wide admission controller, which raises AdmissionRejected when its
+    queue is full. Pass token, session_id and services when calling from a
+    worker thread, which cannot read session state or the cached resources.
+    When model is given, every attempt is recorded in the model health
+    tracker; with trace, each attempt is a span.
+    """
+    token = token or st.session_state.hf_token
+    session_id = session_id or st.session_state.user_id
+    services = services or Services()
+    headers = {"Authorization": f"Bearer {token}"}
+    session = services.http
+    health = services.health
+    admission = services.admission
+    deadline = deadline or Deadline(TURN_DEADLINE)
+    cancel_event = cancel_event or threading.Event()
     
     for attempt in range(max_retries):
+        if cancel_event.is_set() or deadline.expired():
+            return None, None
+        waited = admission.acquire(token, model or url, session_id, deadline, cancel_event)
+        if waited is None:
+            return None, None
+        if trace and waited > 0:
+            trace.add("admission_wait", waited, model=model, attempt=attempt + 1)
+        remaining = deadline.remaining()
+        started = time.monotonic()
         try:
-            response = requests.post(url, headers=headers, json=payload)
-            if response.status_code == 503:
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)  # Exponential backoff
-                    continue
-            # Check for model loading
-            if response.status_code == 200 and isinstance(response.json(), dict) and response.json().get("error") == "Model is loading":
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
-                    continue
-            return response
+            response = session.post(
+                url,
+                headers=headers,
+                json=payload,
+                timeout=(min(CONNECT_TIMEOUT, remaining), min(read_timeout, remaining))
+            )
         except Exception as e:
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)
+            if model:
+                health.record_failure(model)
+            if trace:
+                trace.add("api_request", time.monotonic() - started, model=model, attempt=attempt + 1, error=type(e).__name__)
+            if attempt < max_retries - 1 and wait_before_retry(retry_delay(attempt), deadline, cancel_event):
+                continue
+            raise
+        
+        body = parse_response_body(response)
+        loading = is_model_loading(response, body)
+        if trace:
+            trace.add(
+                "api_request",
+                time.monotonic() - started,
+                model=model,
+                attempt=attempt + 1,
+                status=response.status_code,
+                bytes=len(response.content)
+            )
+        if model:
+            if response.status_code == 200 and not loading:
+                health.record_success(model, time.monotonic() - started)
+            else:
+                health.record_failure(model, loading=loading or response.status_code == 503)
+        
+        if (loading or response.status_code in RETRYABLE_STATUSES) and attempt < max_retries - 1:
+            if wait_before_retry(retry_delay(attempt, response, body), deadline, cancel_event):
+                continue
+        return response, body
+    return None, None
+
+def text_generation_payload(enhanced_prompt, stream=False):
+    """Build the inference payload for a text model"""
+    payload = {
+        "inputs": enhanced_prompt,
+        "parameters": dict(GENERATION_PARAMETERS)
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+class LocalBatchScheduler:
+    """Runs text models on CPU, micro-batching prompts from every session.
+
+    Models are loaded on first use and stay warm for the life of the process.
+    A single worker thread takes the oldest waiting model, gives other prompts
+    for it up to max_wait seconds to arrive, and then runs up to max_batch_size
+    of them through one generate() call.
+    """
+
+    def __init__(self, max_batch_size, max_wait):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = OrderedDict()
+        self.models = {}
+        self.condition = threading.Condition()
+        threading.Thread(target=self._run, name="lumo-local-inference", daemon=True).start()
+
+    def submit(self, model, prompt):
+        """Queue a prompt and return a Future for its generated text"""
+        future = Future()
+        with self.condition:
+            self.pending.setdefault(model, []).append((prompt, future))
+            self.condition.notify()
+        return future
+
+    def queue_depth(self):
+        with self.condition:
+            return sum(len(queue) for queue in self.pending.values())
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            model = next(iter(self.pending))
+            batch_ready_at = time.monotonic() + self.max_wait
+            while len(self.pending[model]) < self.max_batch_size:
+                remaining = batch_ready_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            queue = self.pending.pop(model)
+            if len(queue) > self.max_batch_size:
+                # Leftovers go to the back so other models get a turn
+                self.pending[model] = queue[self.max_batch_size:]
+            return model, queue[:self.max_batch_size]
+
+    def _run(self):
+        while True:
+            model, batch = self._next_batch()
+            batch = [(prompt, future) for prompt, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
                 continue
-            raise e
-    return None
+            try:
+                texts = self._generate(model, [prompt for prompt, _ in batch])
+                for (_, future), text in zip(batch, texts):
+                    future.set_result(text)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
 
-def search_web(query, num_results=5):
-    """Search the web using DuckDuckGo"""
+    def _load(self, model):
+        if model not in self.models:
+            from transformers import AutoConfig, AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoTokenizer
+            config = AutoConfig.from_pretrained(model)
+            # Left padding keeps every prompt flush against its generated tokens, and
+            # left truncation drops the oldest context rather than the request itself
+            tokenizer = AutoTokenizer.from_pretrained(model, padding_side="left", truncation_side="left")
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            model_class = AutoModelForSeq2SeqLM if config.is_encoder_decoder else AutoModelForCausalLM
+            lm = model_class.from_pretrained(model)
+            lm.eval()
+            self.models[model] = (tokenizer, lm)
+        return self.models[model]
+
+    def _generate(self, model, prompts):
+        import torch
+        tokenizer, lm = self._load(model)
+        inputs = tokenizer(
+            prompts,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=prompt_token_budget(model)
+        )
+        with torch.inference_mode():
+            output = lm.generate(
+                **inputs,
+                max_new_tokens=GENERATION_PARAMETERS["max_new_tokens"],
+                do_sample=GENERATION_PARAMETERS["do_sample"],
+                temperature=GENERATION_PARAMETERS["temperature"],
+                top_p=GENERATION_PARAMETERS["top_p"],
+                pad_token_id=tokenizer.pad_token_id
+            )
+        if not lm.config.is_encoder_decoder:
+            # Causal models echo the prompt; keep only the new tokens
+            output = output[:, inputs["input_ids"].shape[1]:]
+        return [text.strip() for text in tokenizer.batch_decode(output, skip_special_tokens=True)]
+
+@st.cache_resource(show_spinner=False)
+def get_local_scheduler():
+    """Local inference scheduler shared by all sessions"""
+    return LocalBatchScheduler(LOCAL_MAX_BATCH_SIZE, LOCAL_MAX_BATCH_WAIT)
+
+def query_local_model(model, enhanced_prompt, scheduler, health, deadline=None, trace=None):
+    """Generate text with a model running in this process"""
+    deadline = deadline or Deadline(TURN_DEADLINE)
+    started = time.monotonic()
+    future = scheduler.submit(model, enhanced_prompt)
+    try:
+        response_text = future.result(timeout=deadline.remaining())
+    except Exception as e:
+        future.cancel()
+        health.record_failure(model)
+        if trace:
+            trace.add("local_generate", time.monotonic() - started, model=model, error=type(e).__name__)
+        return ""
+    health.record_success(model, time.monotonic() - started)
+    if trace:
+        trace.add("local_generate", time.monotonic() - started, model=model, bytes=len(response_text))
+    return response_text
+
+def query_text_model(model, enhanced_prompt, token, session_id, services, cancel_event=None, deadline=None, trace=None):
+    """Ask one text model for a completion and return the generated text"""
+    payload = text_generation_payload(enhanced_prompt)
+    response, body = make_api_request(
+        hf_model_url(model),
+        payload,
+        token=token,
+        cancel_event=cancel_event,
+        model=model,
+        deadline=deadline,
+        trace=trace,
+        session_id=session_id,
+        services=services
+    )
+    if response is not None and response.status_code == 200:
+        return generated_text(body)
+    return ""
+
+def generated_text(body):
+    """Pull the generated text out of a text-generation response body"""
+    if isinstance(body, list) and len(body) > 0 and isinstance(body[0], dict):
+        return body[0].get("generated_text", "").strip()
+    return ""
+
+def open_text_stream(model, enhanced_prompt, token, session_id, services, deadline, cancel_event, trace=None):
+    """Request a server-sent event stream from a text model.
+
+    Returns (response, None) with the open stream, or (None, text) if the
+    model answered with a complete generation instead of streaming. Returns
+    (None, None) if no request slot freed up in time or the model answered
+    with an error, which is recorded in its health.
+    """
+    payload = text_generation_payload(enhanced_prompt, stream=True)
+    waited = services.admission.acquire(token, model, session_id, deadline, cancel_event)
+    if waited is None:
+        return None, None
+    if trace and waited > 0:
+        trace.add("admission_wait", waited, model=model)
+    remaining = deadline.remaining()
+    response = services.http.post(
+        hf_model_url(model),
+        headers={"Authorization": f"Bearer {token}"},
+        json=payload,
+        stream=True,
+        timeout=(min(CONNECT_TIMEOUT, remaining), min(TEXT_READ_TIMEOUT, remaining))
+    )
+    if response.status_code == 200 and response.headers.get("content-type", "").startswith("text/event-stream"):
+        return response, None
+    # A model that does not stream still answers in full; keep that answer
+    # rather than asking for it again on the blocking path
+    body = parse_response_body(response)
+    response.close()
+    if response.status_code != 200:
+        services.health.record_failure(model, loading=response.status_code == 503 or is_model_loading(response, body))
+        return None, None
+    return None, generated_text(body)
+
+def iter_stream_tokens(response):
+    """Yield token text from an open server-sent event stream"""
+    with response:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            if event.get("error"):
+                raise RuntimeError(event["error"])
+            token = event.get("token") or {}
+            if not token.get("special"):
+                yield token.get("text", "")
+
+class TokenStream:
+    """Text a worker thread streams from a model, shown by the script thread.
+
+    The worker puts chunks as they arrive; the script thread calls render(),
+    since only it may update the page.
+    """
+
+    render_interval = 0.05
+
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+        self.chunks = queue.Queue()
+        self.text = ""
+        self.last_render = 0.0
+
+    def put(self, chunk):
+        self.chunks.put(chunk)
+
+    def render(self):
+        """Show the text received so far; returns True once any has arrived"""
+        changed = False
+        while True:
+            try:
+                self.text += self.chunks.get_nowait()
+                changed = True
+            except queue.Empty:
+                break
+        # Throttle re-renders so long answers do not flood the websocket
+        if changed and time.monotonic() - self.last_render > self.render_interval:
+            self.placeholder.markdown(self.text + "▌")
+            self.last_render = time.monotonic()
+        return bool(self.text)
+
+def stream_text_response(model, enhanced_prompt, token, session_id, services, stream, cancel_event, deadline, trace=None):
+    """Stream a model's answer into stream and return the full text.
+
+    Runs on a worker thread. A model that does not stream has its complete
+    answer put on the stream in one piece. Returns "" if the request failed,
+    and raises AdmissionRejected if the request queue is full.
+    Only a good answer counts as a success in the model's health; an empty,
+    short or deadline-truncated one counts as a failure.
+    """
+    started = time.monotonic()
+    first_token_at = None
+    response_text = ""
+    status = 200
     try:
-        with DDGS() as ddgs:
-            results = list(ddgs.text(query, max_results=num_results))
-        return results
+        response, complete_text = open_text_stream(model, enhanced_prompt, token, session_id, services, deadline, cancel_event, trace)
+        if response is None and complete_text is None:
+            if trace:
+                trace.add("stream", time.monotonic() - started, model=model, status="unavailable")
+            return ""
+        if response is None:
+            status = "not streamed"
+            response_text = complete_text
+            stream.put(complete_text)
+        else:
+            for chunk in iter_stream_tokens(response):
+                if cancel_event.is_set():
+                    # Another model answered first
+                    response.close()
+                    if trace:
+                        trace.add("stream", time.monotonic() - started, model=model, status="cancelled")
+                    return response_text.strip()
+                if deadline.expired():
+                    response.close()
+                    status = "out of time"
+                    break
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                    if trace:
+                        trace.add("stream_first_token", first_token_at - started, model=model)
+                response_text += chunk
+                stream.put(chunk)
+    except AdmissionRejected:
+        if trace:
+            trace.add("stream", time.monotonic() - started, model=model, status="rejected")
+        raise
     except Exception as e:
-        st.error(f"Search error: {str(e)}")
-        return []
+        services.health.record_failure(model)
+        if trace:
+            trace.add("stream", time.monotonic() - started, model=model, error=type(e).__name__)
+        return ""
+    response_text = response_text.strip()
+    if status != "out of time" and is_good_response(response_text):
+        services.health.record_success(model, time.monotonic() - started)
+    else:
+        services.health.record_failure(model)
+    if trace:
+        trace.add("stream", time.monotonic() - started, model=model, status=status, bytes=len(response_text))
+    return response_text
+
+def is_good_response(response_text):
+    """Check whether generated text is worth showing"""
+    return bool(response_text) and len(response_text) > 20  # Lower threshold for faster responses
+
+@st.cache_resource
+def get_generation_pool():
+    """Thread pool shared by all sessions for hedged model requests"""
+    return ThreadPoolExecutor(max_workers=int(os.getenv("GENERATION_WORKERS", "16")), thread_name_prefix="lumo-generate")
+
+def generate_hedged(models, query, prompt_for, hedge_delay=HEDGE_DELAY, deadline=None, stream=None):
+    """Race models, starting the next candidate whenever no good answer arrives in time.
+
+    query(model, prompt, cancel_event) runs on a worker thread and returns
+    generated text. prompt_for(model) builds the model's prompt on the calling
+    thread as the model is launched, since it may load a tokenizer. A new
+    candidate is launched after hedge_delay seconds without a good answer, or
+    as soon as a running candidate fails. If the first candidate streams into
+    stream (a TokenStream), the calling thread renders it while waiting and
+    holds further hedges back once its first token has arrived. Returns
+    (model, text) for the first good answer, falling back to the last
+    non-empty text, or (None, "") if every model failed or the deadline passed.
+    AdmissionRejected from any candidate stops the race and is raised.
+    """
+    pool = get_generation_pool()
+    deadline = deadline or Deadline(TURN_DEADLINE)
+    cancel_event = threading.Event()
+    candidates = iter(models)
+    pending = {}
+    fallback = (None, "")
+    
+    def launch_next():
+        model = next(candidates, None)
+        if model is not None:
+            pending[pool.submit(query, model, prompt_for(model), cancel_event)] = model
+    
+    launch_next()
+    streaming = next(iter(pending), None) if stream else None
+    hedge_at = time.monotonic() + hedge_delay
+    while pending and not deadline.expired():
+        timeout = min(hedge_at - time.monotonic(), deadline.remaining())
+        if stream:
+            timeout = min(timeout, stream.render_interval)
+        done, _ = wait(pending, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+        if stream and stream.render() and streaming in pending:
+            # The streaming candidate is answering; only a failure brings in another model
+            hedge_at = float("inf")
+        if not done:
+            if time.monotonic() >= hedge_at:
+                # Hedge: the running candidates are slow, start another one alongside them
+                launch_next()
+                hedge_at = time.monotonic() + hedge_delay
+            continue
+        for future in done:
+            model = pending.pop(future)
+            try:
+                response_text = future.result()
+            except AdmissionRejected:
+                # The request queue is full; the caller tells the user rather than trying more models
+                cancel_event.set()
+                for other in pending:
+                    other.cancel()
+                raise
+            except Exception:
+                response_text = ""
+            if is_good_response(response_text):
+                cancel_event.set()
+                for other in pending:
+                    other.cancel()
+                return model, response_text
+            if response_text:
+                fallback = (model, response_text)
+            # A failed candidate is replaced right away rather than after the hedge delay
+            launch_next()
+            hedge_at = time.monotonic() + hedge_delay
+    cancel_event.set()
+    return fallback
+
+def search_web(query, num_results=5, services=None, deadline=None):
+    """Search the web using DuckDuckGo, giving up once deadline passes"""
+    services = services or Services()
+    deadline = deadline or Deadline(RETRIEVAL_DEADLINES["search"])
+    def fetch():
+        if SEARCH_API_URL:
+            response = services.http.get(
+                SEARCH_API_URL,
+                params={"q": query, "max_results": num_results},
+                timeout=retrieval_timeout(deadline)
+            )
+            response.raise_for_status()
+            return response.json()
+        from duckduckgo_search import DDGS
+        with DDGS(timeout=retrieval_timeout(deadline)[1]) as ddgs:
+            return list(ddgs.text(query, max_results=num_results))
+    return services.retrieval_cache.get_or_fetch(f"search:{num_results}", query, fetch)
 
 def format_response(response_text):
     """Simple response formatting"""
     return response_text.strip()
 
-def save_image(image_bytes):
-    """Save image bytes to a temporary file and return the path"""
+def image_generation_payload(image_prompt):
+    """Build the inference payload for an image model"""
+    return {
+        "inputs": image_prompt,
+        "parameters": {
+            "num_inference_steps": 30,
+            "guidance_scale": 7.5,
+            "width": 512,
+            "height": 512,
+            "negative_prompt": "blurry, distorted, low quality, bad anatomy",
+            "num_images_per_prompt": 1
+        }
+    }
+
+def image_fingerprint(model, image_prompt):
+    """Content address of a generated image"""
+    material = json.dumps({
+        "model": model,
+        "prompt": image_prompt,
+        "parameters": image_generation_payload(image_prompt)["parameters"]
+    }, sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+class ImageStore:
+    """Content-addressed image bytes, in a memory LRU over a directory on disk.
+
+    Originals and transcoded variants share the store under different keys.
+
+    Both tiers are bounded by total size; the disk tier evicts the files that
+    were read or written least recently.
+    """
+
+    def __init__(self, directory, max_memory_bytes, max_disk_bytes):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.img")
+
+    def get(self, key):
+        """Return the image bytes for key, or None"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    image_bytes = f.read()
+                os.utime(path)
+            except OSError:
+                return None
+            self._remember(key, image_bytes)
+            return image_bytes
+
+    def put(self, key, image_bytes):
+        with self.lock:
+            self._remember(key, image_bytes)
+            # Write under a unique name and rename, so readers never see a partial file
+            temp_path = f"{self._path(key)}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(image_bytes)
+            os.replace(temp_path, self._path(key))
+            self._evict_disk()
+
+    def _remember(self, key, image_bytes):
+        if key in self.entries:
+            self.memory_bytes -= len(self.entries.pop(key))
+        self.entries[key] = image_bytes
+        self.memory_bytes += len(image_bytes)
+        while self.memory_bytes > self.max_memory_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".img"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+@st.cache_resource(show_spinner=False)
+def get_image_store():
+    """Generated-image store shared by all sessions"""
     import tempfile
-    import os
-    
-    # Create a temporary file with .png extension
-    temp_dir = tempfile.gettempdir()
-    temp_path = os.path.join(temp_dir, f"lumo_art_{int(time.time())}.png")
-    
-    # Save the image
-    with open(temp_path, "wb") as f:
-        f.write(image_bytes)
+    return ImageStore(
+        os.getenv("IMAGE_STORE_DIR", os.path.join(tempfile.gettempdir(), "lumo_images")),
+        max_memory_bytes=int(float(os.getenv("IMAGE_STORE_MEMORY_MB", "64")) * 1024 * 1024),
+        max_disk_bytes=int(float(os.getenv("IMAGE_STORE_DISK_MB", "512")) * 1024 * 1024)
+    )
+
+def make_preview(image_bytes):
+    """Downscale and compress an image for on-page display.
+
+    Produces WebP, or progressive JPEG if Pillow was built without WebP support.
+    """
+    from PIL import Image
     
-    return temp_path
+    image = Image.open(io.BytesIO(image_bytes))
+    image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    try:
+        image.save(output, format="WEBP", quality=PREVIEW_QUALITY, method=4)
+    except (KeyError, OSError):
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=PREVIEW_QUALITY, optimize=True, progressive=True)
+    return output.getvalue()
+
+def preview_key(image_key):
+    """Store key of an image's display-size preview"""
+    return f"{image_key}-preview-{PREVIEW_SIZE}-q{PREVIEW_QUALITY}"
+
+def get_or_make_preview(image_key, image_bytes, store):
+    """Return the cached preview for an image, transcoding it on first use"""
+    preview_bytes = store.get(preview_key(image_key))
+    if preview_bytes is None:
+        preview_bytes = make_preview(image_bytes)
+        store.put(preview_key(image_key), preview_bytes)
+    return preview_bytes
+
+class ImageJobQueue:
+    """Runs image generation on a bounded background pool.
+
+    Jobs are tracked by id for the life of the process, so a rerun can pick up
+    a job's progress or its finished image. Each user may have only a few jobs
+    in flight, and the queue rejects new jobs once it is full.
+    """
+
+    def __init__(self, max_workers, max_active, per_user_limit, job_ttl, services):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="lumo-image")
+        # The workers have no ScriptRunContext to call the cached getters with
+        self.services = services
+        self.max_active = max_active
+        self.per_user_limit = per_user_limit
+        self.job_ttl = job_ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, user_id, image_prompt, token):
+        """Queue a job; returns (job_id, None) or (None, reason it was rejected)"""
+        with self.lock:
+            self._purge()
+            active = [job for job in self.jobs.values() if job["state"] in ("queued", "running")]
+            if sum(1 for job in active if job["user_id"] == user_id) >= self.per_user_limit:
+                return None, "You already have the maximum number of images in progress. Please wait for one to finish."
+            if len(active) >= self.max_active:
+                return None, "The image generator is busy right now. Please try again in a moment."
+            rejection = self.services.admission.check()
+            if rejection:
+                return None, rejection
+            job_id = str(uuid.uuid4())
+            job = self.jobs[job_id] = {
+                "id": job_id,
+                "user_id": user_id,
+                "prompt": image_prompt,
+                "state": "queued",
+                "progress": 0.0,
+                "status": "Waiting for a free worker...",
+                "image_bytes": None,
+                "preview_bytes": None,
+                "image_key": None,
+                "model": None,
+                "errors": [],
+                "cancel_event": threading.Event(),
+                "trace": Trace("image"),
+                "finished_at": None
+            }
+            # Repeat prompts are served from the image store without a worker
+            store = self.services.image_store
+            for model in IMAGE_MODELS:
+                image_key = image_fingerprint(model, image_prompt)
+                image_bytes = store.get(image_key)
+                preview_bytes = store.get(preview_key(image_key)) if image_bytes else None
+                if preview_bytes:
+                    job.update(image_bytes=image_bytes, preview_bytes=preview_bytes, image_key=image_key, model=model)
+                    self._finish(job, "done", "Done")
+                    return job_id, None
+        self.executor.submit(self._run, job_id, token)
+        return job_id, None
+
+    def get(self, job_id):
+        """Return a snapshot of a job, or None if it is unknown or expired"""
+        with self.lock:
+            # Pages poll this, so finished jobs and their image bytes are freed
+            # even when nobody submits a new job
+            self._purge()
+            job = self.jobs.get(job_id)
+            return dict(job, errors=list(job["errors"])) if job else None
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job and job["state"] in ("queued", "running"):
+                job["cancel_event"].set()
+                self._finish(job, "cancelled", "Cancelled")
+
+    def _update(self, job_id, **changes):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job["state"] in ("queued", "running"):
+                job.update(changes)
+            return job
+
+    def _complete(self, job, trace, model, image_key, image_bytes, errors=None):
+        # Transcoding happens here on the worker, never on the script thread
+        self._update(job["id"], progress=0.95, status="Preparing preview...")
+        try:
+            with trace.span("image_preview") as span:
+                preview_bytes = get_or_make_preview(image_key, image_bytes, self.services.image_store)
+                span["bytes"] = len(preview_bytes)
+        except Exception:
+            preview_bytes = image_bytes
+        with self.lock:
+            if job["state"] == "running":
+                job.update(
+                    image_bytes=image_bytes,
+                    preview_bytes=preview_bytes,
+                    image_key=image_key,
+                    model=model,
+                    errors=errors or []
+                )
+                self._finish(job, "done", "Done")
+
+    def _finish(self, job, state, status):
+        job.update(state=state, status=status, progress=1.0, finished_at=time.time())
+        job["trace"] = self.services.metrics.record(job["trace"])
+
+    def _purge(self):
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job["finished_at"] and time.time() - job["finished_at"] > self.job_ttl
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def _run(self, job_id, token):
+        job = self._update(job_id, state="running")
+        if job["state"] != "running":
+            # Cancelled while it was still queued
+            return
+        cancel_event = job["cancel_event"]
+        trace = job["trace"]
+        
+        # A stored original only needs its preview made again
+        for model in IMAGE_MODELS:
+            image_key = image_fingerprint(model, job["prompt"])
+            image_bytes = self.services.image_store.get(image_key)
+            if image_bytes:
+                self._complete(job, trace, model, image_key, image_bytes)
+                return
+        
+        # Try healthy models, fastest first
+        models = self.services.health.rank(IMAGE_MODELS)
+        deadline = Deadline(IMAGE_DEADLINE)
+        errors = []
+        
+        for index, model in enumerate(models):
+            if cancel_event.is_set():
+                return
+            self._update(
+                job_id,
+                progress=index / len(models),
+                status=f"Trying {model.split('/')[-1]} ({index + 1}/{len(models)})..."
+            )
+            try:
+                response, _ = make_api_request(
+                    hf_model_url(model),
+                    image_generation_payload(job["prompt"]),
+                    read_timeout=IMAGE_READ_TIMEOUT,
+                    token=token,
+                    cancel_event=cancel_event,
+                    model=model,
+                    deadline=deadline,
+                    trace=trace,
+                    session_id=job["user_id"],
+                    services=self.services
+                )
+                if response is None:
+                    if cancel_event.is_set():
+                        return
+                    errors.append(f"Model {model} skipped: out of time")
+                    continue
+                elif response.status_code == 200:
+                    image_bytes = response.content
+                    try:
+                        # Decode here so a broken image never reaches the page
+                        with trace.span("image_decode", model=model, bytes=len(image_bytes)):
+                            from PIL import Image
+                            Image.open(io.BytesIO(image_bytes)).verify()
+                    except Exception as e:
+                        errors.append(f"Failed to process image from {model}: {str(e)}")
+                        continue
+                    image_key = image_fingerprint(model, job["prompt"])
+                    with trace.span("image_save", bytes=len(image_bytes)):
+                        self.services.image_store.put(image_key, image_bytes)
+                    self._complete(job, trace, model, image_key, image_bytes, errors)
+                    return
+                elif response.status_code == 401:
+                    errors.append("Invalid API token. Please check your Hugging Face API token in the sidebar settings.")
+                    break
+                else:
+                    errors.append(f"Model {model} failed with status {response.status_code}")
+                    continue
+            except AdmissionRejected as e:
+                errors.append(str(e))
+                break
+            except requests.exceptions.Timeout:
+                errors.append(f"Model {model} timed out")
+                continue
+            except Exception as e:
+                errors.append(f"Model {model}: {str(e)}")
+                continue
+        
+        with self.lock:
+            if job["state"] == "running":
+                job["errors"] = errors
+                self._finish(job, "failed", "Failed to generate image")
+
+@st.cache_resource(show_spinner=False)
+def get_image_jobs():
+    """Image job queue shared by all sessions"""
+    return ImageJobQueue(
+        max_workers=int(os.getenv("IMAGE_WORKERS", "4")),
+        max_active=int(os.getenv("IMAGE_QUEUE_SIZE", "32")),
+        per_user_limit=int(os.getenv("IMAGE_JOBS_PER_USER", "2")),
+        job_ttl=float(os.getenv("IMAGE_JOB_TTL", "3600")),
+        services=Services()
+    )
+
+def render_trace(trace_entry):
+    """Show a trace's timed spans in a collapsed expander"""
+    with st.expander(f"⏱ Timing: {trace_entry['total_ms'] / 1000:.2f}s"):
+        st.dataframe(trace_entry["spans"], use_container_width=True, hide_index=True)
 
 # Load environment variables
 load_dotenv()
 
+def new_guest_id():
+    return f"{GUEST_ID_PREFIX}{uuid.uuid4()}"
+
+def sign_in(username):
+    """Switch the session to an account, or to a fresh guest with None.
+
+    Signing in from a guest session moves the guest's chats to the account and
+    keeps the current chat open.
+    """
+    if username and not st.session_state.username:
+        get_chat_store().move_chats(st.session_state.user_id, username)
+    else:
+        create_new_chat()
+    st.session_state.username = username
+    st.session_state.user_id = username or new_guest_id()
+    st.session_state.chat_page = 0
+
 def create_new_chat():
     """Create a new chat and return its ID"""
     chat_id = str(uuid.uuid4())
     st.session_state.current_chat = chat_id
     st.session_state.messages = []
+    st.session_state.visible_messages = MESSAGE_WINDOW
     return chat_id
 
+def add_message(role, content, trace=None):
+    """Append a message to the current chat, in memory and in the chat store.
+
+    A trace is kept with the in-memory copy only, for the timing panel.
+    """
+    message = {"role": role, "content": content}
+    if trace:
+        message["trace"] = trace
+    st.session_state.messages.append(message)
+    get_chat_store().append_message(st.session_state.current_chat, st.session_state.user_id, role, content)
+
 # Set page config
 st.set_page_config(
     page_title="Lumo.ai",
@@ -208,15 +2320,29 @@ st.set_page_config(
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = {}
+if "visible_messages" not in st.session_state:
+    st.session_state.visible_messages = MESSAGE_WINDOW
+if "chat_page" not in st.session_state:
+    st.session_state.chat_page = 0
+if "show_traces" not in st.session_state:
+    st.session_state.show_traces = False
+if "image_jobs" not in st.session_state:
+    st.session_state.image_jobs = []
+if "user_id" not in st.session_state:
+    # Guests get chats for this session only; signing in moves them to the account
+    st.session_state.username = None
+    st.session_state.user_id = new_guest_id()
 if "current_chat" not in st.session_state:
     st.session_state.current_chat = str(uuid.uuid4())
 if "hf_token" not in st.session_state:
     st.session_state.hf_token = os.getenv("HUGGINGFACE_TOKEN")
+if "inference_backend" not in st.session_state:
+    st.session_state.inference_backend = INFERENCE_BACKEND
 
-# Add CSS for modern styling
-st.markdown("""
+@st.cache_resource(show_spinner=False)
+def get_page_style():
+    """Page CSS with comments and indentation stripped, built once per process"""
+    css = """
 <style>
     /* Main content gradient background */
     .main .block-container {
@@ -315,10 +2441,45 @@ st.markdown("""
         -webkit-backdrop-filter: blur(10px) !important;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    return "\n".join(line.strip() for line in css.splitlines() if line.strip())
+
+# Add CSS for modern styling
+st.markdown(get_page_style(), unsafe_allow_html=True)
 
 # Update sidebar with modern styling
 with st.sidebar:
+    if st.session_state.username:
+        st.caption(f"Signed in as **{st.session_state.username}**")
+        if st.button("Sign out", key="sign_out_btn", use_container_width=True):
+            sign_in(None)
+            st.rerun()
+    else:
+        with st.expander("👤 Sign in to keep your chats"):
+            with st.form("sign_in_form"):
+                username = st.text_input("Username").strip()
+                password = st.text_input("Password", type="password")
+                sign_in_col, sign_up_col = st.columns(2)
+                signing_in = sign_in_col.form_submit_button("Sign in")
+                signing_up = sign_up_col.form_submit_button("Create account")
+            if signing_up:
+                account_error = get_user_store().create(username, password)
+                if account_error:
+                    st.error(account_error)
+                else:
+                    sign_in(username)
+                    st.rerun()
+            elif signing_in:
+                locked_for = get_user_store().locked_for(username)
+                if locked_for:
+                    st.error(f"Too many failed sign-ins. Try again in {int(locked_for // 60) + 1} minute(s).")
+                elif get_user_store().verify(username, password):
+                    sign_in(username)
+                    st.rerun()
+                else:
+                    st.error("Wrong username or password.")
+    
     st.markdown('<div class="sidebar-header">💬 Chat History</div>', unsafe_allow_html=True)
     
     # New chat button with modern styling
@@ -328,18 +2489,43 @@ with st.sidebar:
     
     st.markdown("<div style='height: 1px; background-color: var(--border-color); margin: 1rem 0;'></div>", unsafe_allow_html=True)
     
-    # Display chat history with modern styling
-    for chat_id, messages in st.session_state.chat_history.items():
+    # Display chat history with modern styling, one page at a time
+    chat_search = st.text_input("Search chats", placeholder="🔍 Search chats", label_visibility="collapsed")
+    if chat_search != st.session_state.get("last_chat_search", ""):
+        st.session_state.last_chat_search = chat_search
+        st.session_state.chat_page = 0
+    chats, chat_count = get_chat_store().list_chats(
+        st.session_state.user_id,
+        search=chat_search,
+        limit=CHATS_PER_PAGE,
+        offset=st.session_state.chat_page * CHATS_PER_PAGE
+    )
+    for chat_id, title in chats:
         if st.button(
-            f"💭 Chat {chat_id[:8]}...",
+            f"💭 {title or f'Chat {chat_id[:8]}...'}",
             key=chat_id,
             use_container_width=True,
             help="Click to load this chat"
         ):
             st.session_state.current_chat = chat_id
-            st.session_state.messages = messages
+            st.session_state.messages = get_chat_store().load_messages(chat_id)
+            st.session_state.visible_messages = MESSAGE_WINDOW
             st.rerun()
     
+    page_count = max(1, -(-chat_count // CHATS_PER_PAGE))
+    if page_count > 1:
+        prev_col, page_col, next_col = st.columns([1, 2, 1])
+        with prev_col:
+            if st.button("‹", key="chat_page_prev", disabled=st.session_state.chat_page == 0):
+                st.session_state.chat_page -= 1
+                st.rerun()
+        with page_col:
+            st.caption(f"Page {st.session_state.chat_page + 1} of {page_count}")
+        with next_col:
+            if st.button("›", key="chat_page_next", disabled=st.session_state.chat_page >= page_count - 1):
+                st.session_state.chat_page += 1
+                st.rerun()
+    
     st.markdown("<div style='height: 1px; background-color: var(--border-color); margin: 1rem 0;'></div>", unsafe_allow_html=True)
     
     # Settings section
@@ -366,9 +2552,56 @@ with st.sidebar:
         if hf_token and hf_token != st.session_state.hf_token:
             st.session_state.hf_token = hf_token
             st.success("Token updated!")
+    
+    with st.expander("Inference Backend"):
+        # Options are the display labels, so the widget's value is what is shown
+        backends = {"Hugging Face API": "api", "Local CPU": "local"}
+        backend_label = st.radio(
+            "Run text models on",
+            list(backends),
+            index=list(backends.values()).index(st.session_state.inference_backend),
+            help="Local CPU keeps models loaded in this process and batches requests from all users"
+        )
+        st.session_state.inference_backend = backends[backend_label]
+    
+    with st.expander("Caches"):
+        for cache_name, cache in (("Retrieval", get_retrieval_cache()), ("Answers", get_response_cache())):
+            cache_stats = cache.stats
+            st.markdown(
+                f"**{cache_name}**  \n"
+                f"Memory hits: **{cache_stats['memory_hits']}**  \n"
+                f"Disk hits: **{cache_stats['disk_hits']}**  \n"
+                f"Misses: **{cache_stats['misses']}**"
+            )
+    
+    with st.expander("Latency"):
+        st.toggle("Show timing under replies", key="show_traces")
+        latency_rows = get_metrics().summary()
+        if latency_rows:
+            st.dataframe(latency_rows, use_container_width=True, hide_index=True)
+        else:
+            st.caption("No requests timed yet")
+    
+    with st.expander("Request Queue"):
+        admission_stats = get_admission().stats()
+        st.markdown(
+            f"Waiting: **{admission_stats['waiting']}** / {admission_stats['queue_size']} "
+            f"from **{admission_stats['waiting_sessions']}** session(s)  \n"
+            f"Wait p50 / p95: **{admission_stats['p50_wait_s'] or 0}s** / **{admission_stats['p95_wait_s'] or 0}s**  \n"
+            f"Admitted: **{admission_stats['admitted']}**  \n"
+            f"Rejected: **{admission_stats['rejected']}**"
+        )
+    
+    with st.expander("Model Health"):
+        health_rows = get_model_health().snapshot()
+        if health_rows:
+            st.dataframe(health_rows, use_container_width=True, hide_index=True)
+        else:
+            st.caption("No model requests yet")
 
 # Check if token is set
-if not st.session_state.hf_token:
+# Local inference needs no token; the Create tab checks for one itself
+if not st.session_state.hf_token and st.session_state.inference_backend != "local":
     st.markdown(
         '<div class="token-warning">'
         '<span>⚠️</span>'
@@ -390,18 +2623,30 @@ with tab1:
     # Message container
     st.markdown('<div class="message-container">', unsafe_allow_html=True)
     
-    # Display chat messages
-    for message in st.session_state.messages:
+    # Display the most recent chat messages; older ones load on request
+    hidden_count = len(st.session_state.messages) - st.session_state.visible_messages
+    if hidden_count > 0:
+        if st.button(f"⬆ Load earlier messages ({hidden_count} hidden)", key="load_earlier"):
+            st.session_state.visible_messages += MESSAGE_WINDOW
+            st.rerun()
+    for message in st.session_state.messages[-st.session_state.visible_messages:]:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
+            if st.session_state.show_traces and message.get("trace"):
+                render_trace(message["trace"])
     
     st.markdown('</div>', unsafe_allow_html=True)
     st.markdown('</div>', unsafe_allow_html=True)
     
     # Fixed chat input at the bottom
     st.markdown('<div class="chat-input-container">', unsafe_allow_html=True)
+    fresh_answer = st.toggle(
+        "🔄 Fresh answer",
+        key="fresh_answer",
+        help="Skip previously generated answers and sample a new one"
+    )
     if prompt := st.chat_input("Message your AI assistant..."):
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        add_message("user", prompt)
         
         # Immediately display user message
         with st.chat_message("user"):
@@ -414,56 +2659,118 @@ with tab1:
                 if is_greeting(prompt):
                     response_text = get_greeting_response()
                     message_placeholder.markdown(response_text)
-                    st.session_state.messages.append({"role": "assistant", "content": response_text})
+                    add_message("assistant", response_text)
+                elif admission_rejection := (st.session_state.inference_backend != "local" and get_admission().check()):
+                    # Turn the request away now rather than queueing it behind a full queue
+                    message_placeholder.warning(admission_rejection)
                 else:
-                    search_results = search_web(prompt) if should_use_web_search(prompt) else None
-                    enhanced_prompt = create_assistant_prompt(prompt, search_results)
+                    trace = Trace("chat")
+                    # Fetch only the sources the chosen template uses, concurrently
+                    with trace.span("retrieval_plan") as span:
+                        intent, lookups, skipped_sources = plan_retrieval(prompt)
+                        # Shown in the timing panel and the metrics log
+                        span.update(intent=intent, fetched=", ".join(lookups), skipped=", ".join(skipped_sources))
+                    retrieved, retrieval_errors = run_retrieval(lookups, trace)
+                    for error in retrieval_errors:
+                        st.error(error)
+                    if PASSAGE_RANKING and (retrieved.get("search") or retrieved.get("wikipedia")):
+                        with trace.span("passage_ranking") as span:
+                            retrieved = rank_passages(retrieved, prompt)
+                            span["passages"] = len(retrieved.get("search") or []) + bool(retrieved.get("wikipedia"))
+                    # Follow-ups see recent messages verbatim and older ones as a rolling summary
+                    history = st.session_state.messages[:-1]
+                    summary_lines, recent_messages = [], []
+                    if CONVERSATION_CONTEXT and history:
+                        with trace.span("conversation_summary"):
+                            summary_lines = update_conversation_summary(st.session_state.current_chat, history)
+                        # history[-0:] would be the whole history
+                        recent_messages = history[-CONTEXT_RECENT_MESSAGES:] if CONTEXT_RECENT_MESSAGES > 0 else []
+                    # Each model gets a prompt packed to its own context window
+                    enhanced_prompts = {}
+                    def prompt_for(model):
+                        if model not in enhanced_prompts:
+                            with trace.span("create_prompt", model=model) as span:
+                                enhanced_prompts[model] = create_assistant_prompt(
+                                    prompt,
+                                    retrieved.get("search"),
+                                    retrieved.get("wikipedia"),
+                                    model,
+                                    conversation_context(summary_lines, recent_messages, model)
+                                )
+                                span["bytes"] = len(enhanced_prompts[model])
+                        return enhanced_prompts[model]
+                    
+                    hf_token = st.session_state.hf_token
+                    user_id = st.session_state.user_id
+                    backend = st.session_state.inference_backend
+                    use_local = backend == "local"
+                    # Workers get the shared objects from the script thread
+                    services = Services()
+                    candidates = services.health.rank(TEXT_MODELS)
+                    deadline = Deadline(TURN_DEADLINE)
+                    response_cache = get_response_cache()
+                    model = None
+                    response_text = ""
+                    from_cache = False
                     
-                    with st.spinner("Thinking..."):
-                        # Try different models in order of preference (faster models first)
-                        models = [
-                            "facebook/opt-350m",  # Fastest model
-                            "gpt2",  # Quick response
-                            "EleutherAI/gpt-neo-125M",  # Lightweight
-                            "google/flan-t5-small"  # Efficient for short responses
-                        ]
-                        
-                        response = None
-                        response_text = ""
-                        
-                        for model in models:
-                            try:
-                                API_URL = f"https://api-inference.huggingface.co/models/{model}"
-                                # Add parameters for faster generation
-                                payload = {
-                                    "inputs": enhanced_prompt,
-                                    "parameters": {
-                                        "max_length": 500,  # Limit response length
-                                        "num_return_sequences": 1,
-                                        "temperature": 0.7,  # Balance between creativity and speed
-                                        "top_p": 0.9,
-                                        "do_sample": True
-                                    }
-                                }
-                                response = make_api_request(API_URL, payload)
-                                if response and response.status_code == 200:
-                                    response_json = response.json()
-                                    if isinstance(response_json, list) and len(response_json) > 0:
-                                        response_text = response_json[0].get("generated_text", "").strip()
-                                        if response_text and len(response_text) > 20:  # Lower threshold for faster responses
-                                            break
-                            except Exception:
-                                continue
-                        
-                        if response and response.status_code == 200 and response_text:
-                            formatted_response = format_response(response_text)
-                            message_placeholder.markdown(formatted_response)
-                            st.session_state.messages.append({"role": "assistant", "content": formatted_response})
-                        else:
-                            message_placeholder.error("I apologize, but I'm having trouble generating a response right now. Please try again in a moment.")
-                
-                # Save chat history
-                st.session_state.chat_history[st.session_state.current_chat] = st.session_state.messages
+                    fingerprint = response_fingerprint({
+                        "prompt": prompt,
+                        "retrieved": retrieved,
+                        "summary": summary_lines,
+                        "recent": [(message["role"], message["content"]) for message in recent_messages]
+                    }, backend)
+                    
+                    # Serve a previous answer to the same inputs unless a fresh sample was asked for
+                    if not fresh_answer:
+                        with trace.span("response_cache") as span:
+                            from_cache, cached = response_cache.get(fingerprint)
+                            span["hit"] = from_cache
+                        if from_cache:
+                            model, response_text = cached["model"], cached["text"]
+                    
+                    admission_rejection = None
+                    if not response_text and use_local:
+                        scheduler = get_local_scheduler()
+                        with st.spinner("Thinking..."):
+                            # Local models only fall back on failure; hedging would load extra models
+                            model, response_text = generate_hedged(
+                                candidates,
+                                lambda model, model_prompt, cancel_event: query_local_model(model, model_prompt, scheduler, services.health, deadline, trace),
+                                prompt_for,
+                                hedge_delay=TURN_DEADLINE,
+                                deadline=deadline
+                            )
+                    elif not response_text:
+                        # The first model streams into the placeholder while the hedge timer runs;
+                        # the others answer with blocking requests
+                        stream = TokenStream(message_placeholder) if STREAMING_ENABLED else None
+                        def query_model(model, model_prompt, cancel_event):
+                            if stream and model == candidates[0]:
+                                return stream_text_response(model, model_prompt, hf_token, user_id, services, stream, cancel_event, deadline, trace)
+                            return query_text_model(model, model_prompt, hf_token, user_id, services, cancel_event, deadline, trace)
+                        try:
+                            if stream:
+                                model, response_text = generate_hedged(candidates, query_model, prompt_for, deadline=deadline, stream=stream)
+                            else:
+                                with st.spinner("Thinking..."):
+                                    model, response_text = generate_hedged(candidates, query_model, prompt_for, deadline=deadline)
+                        except AdmissionRejected as e:
+                            admission_rejection = str(e)
+                    
+                    if model and is_good_response(response_text) and not from_cache:
+                        response_cache.set(fingerprint, {"model": model, "text": response_text})
+                    
+                    trace_entry = get_metrics().record(trace)
+                    if response_text:
+                        formatted_response = format_response(response_text)
+                        message_placeholder.markdown(formatted_response)
+                        add_message("assistant", formatted_response, trace=trace_entry)
+                    elif admission_rejection:
+                        message_placeholder.warning(admission_rejection)
+                    else:
+                        message_placeholder.error("I apologize, but I'm having trouble generating a response right now. Please try again in a moment.")
+                    if st.session_state.show_traces:
+                        render_trace(trace_entry)
             
             except Exception as e:
                 message_placeholder.error(f"I apologize, but an error occurred. Please try again. Error details: {str(e)}")
@@ -472,6 +2779,8 @@ with tab1:
 # Image Generation tab
 with tab2:
     st.markdown("### Create AI Art")
+    # Progress bars of running jobs, refreshed in place at the end of the script
+    image_progress = {}
     
     # Check for API token first
     if not st.session_state.hf_token:
@@ -498,91 +2807,69 @@ with tab2:
                 if not image_prompt:
                     st.warning("Please enter a description")
                 else:
-                    try:
-                        with st.spinner("Creating your masterpiece..."):
-                            # Try different models in order of preference
-                            models = [
-                                "stabilityai/stable-diffusion-2-1",
-                                "CompVis/stable-diffusion-v1-4",
-                                "runwayml/stable-diffusion-v1-5"
-                            ]
-                            
-                            response = None
-                            error_messages = []
-                            image_bytes = None
-                            
-                            for model in models:
-                                try:
-                                    API_URL = f"https://api-inference.huggingface.co/models/{model}"
-                                    headers = {"Authorization": f"Bearer {st.session_state.hf_token}"}
-                                    
-                                    payload = {
-                                        "inputs": image_prompt,
-                                        "parameters": {
-                                            "num_inference_steps": 30,
-                                            "guidance_scale": 7.5,
-                                            "width": 512,
-                                            "height": 512,
-                                            "negative_prompt": "blurry, distorted, low quality, bad anatomy",
-                                            "num_images_per_prompt": 1
-                                        }
-                                    }
-                                    
-                                    response = requests.post(
-                                        API_URL,
-                                        headers=headers,
-                                        json=payload,
-                                        timeout=30
-                                    )
-                                    
-                                    if response.status_code == 200:
-                                        image_bytes = response.content
-                                        try:
-                                            image = Image.open(io.BytesIO(image_bytes))
-                                            # Create container for image and download button
-                                            st.markdown('<div class="image-container">', unsafe_allow_html=True)
-                                            st.image(image, caption=image_prompt, use_container_width=True)
-                                            
-                                            # Save image and create download button
-                                            if image_bytes:
-                                                temp_path = save_image(image_bytes)
-                                                with open(temp_path, "rb") as f:
-                                                    btn = st.download_button(
-                                                        label="⬇ Download Image",
-                                                        data=f,
-                                                        file_name=f"lumo_art_{int(time.time())}.png",
-                                                        mime="image/png",
-                                                        use_container_width=True
-                                                    )
-                                            st.markdown('</div>', unsafe_allow_html=True)
-                                            break
-                                        except Exception as e:
-                                            error_messages.append(f"Failed to process image from {model}: {str(e)}")
-                                            continue
-                                    elif response.status_code == 401:
-                                        st.error("Invalid API token. Please check your Hugging Face API token in the sidebar settings.")
-                                        break
-                                    else:
-                                        error_messages.append(f"Model {model} failed with status {response.status_code}")
-                                        continue
-                                        
-                                except requests.exceptions.Timeout:
-                                    error_messages.append(f"Model {model} timed out")
-                                    continue
-                                except Exception as e:
-                                    error_messages.append(f"Model {model}: {str(e)}")
-                                    continue
-                            
-                            if not response or response.status_code != 200:
-                                st.error("Failed to generate image. Please try again.")
-                                with st.expander("Error Details"):
-                                    for error in error_messages:
-                                        st.error(error)
-                                    st.info("Tips:\n1. Try a simpler prompt\n2. Check your API token\n3. Try again in a few moments")
-                                        
-                    except Exception as e:
-                        st.error(f"An unexpected error occurred: {str(e)}")
-                        st.info("Please make sure your API token is valid and try again.")
+                    job_id, rejection = get_image_jobs().submit(
+                        st.session_state.user_id,
+                        image_prompt,
+                        st.session_state.hf_token
+                    )
+                    if rejection:
+                        st.warning(rejection)
+                    else:
+                        st.session_state.image_jobs.insert(0, job_id)
+        
+        # Jobs run in the background; show their progress or results
+        for job_id in list(st.session_state.image_jobs):
+            job = get_image_jobs().get(job_id)
+            if job is None:
+                st.session_state.image_jobs.remove(job_id)
+                continue
+            
+            if job["state"] in ("queued", "running"):
+                progress_col, cancel_col = st.columns([3, 1])
+                with progress_col:
+                    image_progress[job_id] = st.empty()
+                    image_progress[job_id].progress(job["progress"], text=f"Creating your masterpiece: {job['status']}")
+                with cancel_col:
+                    if st.button("✕ Cancel", key=f"cancel_{job_id}", use_container_width=True):
+                        get_image_jobs().cancel(job_id)
+                        st.rerun()
+                continue
+            
+            if job["state"] == "done":
+                # Create container for image and download button
+                st.markdown('<div class="image-container">', unsafe_allow_html=True)
+                try:
+                    # Show the compressed preview; the download keeps the original PNG
+                    st.image(job["preview_bytes"], caption=job["prompt"], use_column_width=True)
+                    
+                    # Serve the download straight from memory
+                    st.download_button(
+                        label="⬇ Download Image",
+                        data=job["image_bytes"],
+                        file_name=f"lumo_art_{job['image_key'][:12]}.png",
+                        mime="image/png",
+                        key=f"download_{job_id}",
+                        use_container_width=True
+                    )
+                except Exception as e:
+                    # One broken job must not take down the tab or hide its Dismiss button
+                    st.error(f"Error displaying image: {str(e)}")
+                st.markdown('</div>', unsafe_allow_html=True)
+            elif job["state"] == "failed":
+                st.error("Failed to generate image. Please try again.")
+                with st.expander("Error Details"):
+                    for error in job["errors"]:
+                        st.error(error)
+                    st.info("Tips:\n1. Try a simpler prompt\n2. Check your API token\n3. Try again in a few moments")
+            else:
+                st.info(f"Cancelled: {job['prompt']}")
+            
+            if st.session_state.show_traces:
+                render_trace(job["trace"])
+            
+            if st.button("Dismiss", key=f"dismiss_{job_id}"):
+                st.session_state.image_jobs.remove(job_id)
+                st.rerun()
 
 # Footer
 st.markdown("---")
@@ -590,4 +2877,23 @@ st.markdown("""
 <footer>
     <p>LUMO.AI - MADE WITH ❤️ BY M.SUBHAN</p>
 </footer>
-""", unsafe_allow_html=True) 
\ No newline at end of file
+""", unsafe_allow_html=True)
+
+# Refresh only the progress bars of running image jobs. The page reruns once
+# when a job leaves the queue, or after IMAGE_POLL_WINDOW so the loop stays bounded;
+# a click on Cancel interrupts the loop at the next progress update.
+if image_progress:
+    polling_until = time.monotonic() + IMAGE_POLL_WINDOW
+    while time.monotonic() < polling_until:
+        time.sleep(IMAGE_POLL_INTERVAL)
+        jobs = get_image_jobs()
+        finished = False
+        for job_id, bar in image_progress.items():
+            job = jobs.get(job_id)
+            if job is None or job["state"] not in ("queued", "running"):
+                finished = True
+                break
+            bar.progress(job["progress"], text=f"Creating your masterpiece: {job['status']}")
+        if finished:
+            break
+    st.rerun()
@@ -0,0 +1,276 @@
+"""Local stand-ins for the external services app.py talks to.
+
+Run one from the command line and point the app at it, for example:
+
+    python benchmarks/fake_services.py wikipedia --port 8001
+    WIKIPEDIA_API_URL=http://localhost:8001/w/api.php streamlit run app.py
+
+    python benchmarks/fake_services.py search --port 8002
+    SEARCH_API_URL=http://localhost:8002/search streamlit run app.py
+
+    python benchmarks/fake_services.py inference --port 8003 --error-rate 0.2 --loading-requests 2
+    HF_API_BASE=http://localhost:8003/models streamlit run app.py
+"""
+import argparse
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ARTICLES = {
+    "Python (programming language)": {
+        "intro": "Python is a high-level, general-purpose programming language. Its design philosophy emphasizes code readability with the use of significant indentation.",
+        "sections": {
+            "History": "Python was conceived in the late 1980s by Guido van Rossum at Centrum Wiskunde & Informatica in the Netherlands as a successor to the ABC programming language.",
+            "Design philosophy and features": "Python is a multi-paradigm programming language. Object-oriented programming and structured programming are fully supported."
+        }
+    },
+    "Climate change": {
+        "intro": "Climate change is the long-term shift in global temperatures and weather patterns. Since the mid-20th century humans have been the main driver of climate change, primarily by burning fossil fuels.",
+        "sections": {
+            "Causes": "Greenhouse gases such as carbon dioxide and methane trap heat in the atmosphere.",
+            "Effects": "Effects include rising sea levels, more extreme weather and the loss of biodiversity."
+        }
+    },
+    "Artificial intelligence": {
+        "intro": "Artificial intelligence is the intelligence of machines or software, as opposed to the intelligence of living beings.",
+        "sections": {
+            "Goals": "The general problem of simulating intelligence has been broken into subproblems such as reasoning, knowledge representation, planning and learning.",
+            "History": "Artificial intelligence was founded as an academic discipline in 1956."
+        }
+    },
+    "Mercury": {
+        "intro": "Mercury may refer to:",
+        "sections": {},
+        "disambiguation": True
+    }
+}
+
+
+def article_text(article):
+    """Render an article the way TextExtracts does with exsectionformat=wiki"""
+    parts = [article["intro"]]
+    for heading, body in article["sections"].items():
+        parts.append(f"\n== {heading} ==\n{body}")
+    return "\n".join(parts)
+
+
+def search_articles(query):
+    """Rank article titles by how many query words they mention"""
+    words = set(query.lower().split())
+    scored = []
+    for title, article in ARTICLES.items():
+        text = f"{title} {article['intro']}".lower()
+        score = sum(1 for word in words if word in text)
+        if score:
+            scored.append((score, title))
+    return [title for score, title in sorted(scored, key=lambda item: -item[0])]
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    """Shared plumbing for the fake services"""
+
+    latency = 0.0
+
+    def send_json(self, data, status=200, headers=None):
+        self.send_body(json.dumps(data).encode(), "application/json; charset=utf-8", status, headers)
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeWikipediaHandler(FakeServiceHandler):
+    """Answers the MediaWiki action=query calls app.py makes"""
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path != "/w/api.php" or params.get("action") != "query":
+            self.send_json({"error": {"code": "badrequest"}}, status=400)
+            return
+
+        if params.get("generator") == "search":
+            titles = search_articles(params.get("gsrsearch", ""))[:int(params.get("gsrlimit", 10))]
+        else:
+            titles = [title for title in params.get("titles", "").split("|") if title in ARTICLES]
+
+        pages = []
+        for index, title in enumerate(titles, start=1):
+            article = ARTICLES[title]
+            page = {"title": title, "index": index}
+            if "extracts" in params.get("prop", ""):
+                page["extract"] = article["intro"] if params.get("exintro") else article_text(article)
+            if "url" in params.get("inprop", ""):
+                page["fullurl"] = "https://en.wikipedia.org/wiki/" + title.replace(" ", "_")
+            if article.get("disambiguation") and "pageprops" in params.get("prop", ""):
+                page["pageprops"] = {"disambiguation": ""}
+            pages.append(page)
+        self.send_json({"batchcomplete": True, "query": {"pages": pages}} if pages else {"batchcomplete": True})
+
+
+class FakeSearchHandler(FakeServiceHandler):
+    """Returns DuckDuckGo-style text results for GET /search?q=...&max_results=..."""
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path != "/search":
+            self.send_json({"error": "not found"}, status=404)
+            return
+        query = params.get("q", "")
+        titles = search_articles(query) or list(ARTICLES)
+        results = []
+        for title in titles[:int(params.get("max_results", 5))]:
+            article = ARTICLES[title]
+            results.append({
+                "title": title,
+                "href": "https://example.com/" + title.replace(" ", "_"),
+                "body": f"{article['intro']} Related to {query}."
+            })
+        self.send_json(results)
+
+
+def solid_png(width, height, rgb):
+    """Encode a single-colour RGB PNG without needing Pillow"""
+    row = b"\x00" + bytes(rgb) * width
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+
+class FakeInferenceHandler(FakeServiceHandler):
+    """Mimics the Hugging Face inference API at POST /models/<model>.
+
+    Image models (names containing "diffusion") return a PNG, text models a
+    generated_text list or, when the payload asks for it, a server-sent event
+    stream. The first loading_requests calls to each model answer 503 "Model is
+    loading" with an estimated_time, and error_rate of the remaining calls fail
+    with a plain 503. Streams wait stream_stall seconds before their first token.
+    """
+
+    error_rate = 0.0
+    loading_requests = 0
+    estimated_time = 0.5
+    stream = True
+    stream_stall = 0.0
+    calls = {}
+    calls_lock = threading.Lock()
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        if not url.path.startswith("/models/"):
+            self.send_json({"error": "not found"}, status=404)
+            return
+        model = url.path[len("/models/"):]
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        with self.calls_lock:
+            self.calls[model] = self.calls.get(model, 0) + 1
+            call_number = self.calls[model]
+        if call_number <= self.loading_requests:
+            self.send_json({"error": f"Model {model} is currently loading", "estimated_time": self.estimated_time}, status=503)
+            return
+        if random.random() < self.error_rate:
+            self.send_json({"error": "Service Unavailable"}, status=503)
+            return
+
+        if "diffusion" in model:
+            self.send_body(solid_png(64, 64, (random.randrange(256), 128, 200)), "image/png")
+            return
+
+        words = f"Here is a locally generated answer from {model} about the question you asked, written for benchmarking.".split()
+        if payload.get("stream") and self.stream:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            time.sleep(self.stream_stall)
+            try:
+                for index, word in enumerate(words):
+                    event = {"token": {"text": (" " if index else "") + word, "special": False}, "generated_text": None}
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up on the stream, e.g. after another model answered
+                pass
+            return
+        # Like the real API, the prompt is echoed back unless return_full_text is false
+        prefix = "" if payload.get("parameters", {}).get("return_full_text") is False else payload.get("inputs", "") + " "
+        self.send_json([{"generated_text": prefix + " ".join(words)}])
+
+
+SERVICES = {
+    "wikipedia": FakeWikipediaHandler,
+    "search": FakeSearchHandler,
+    "inference": FakeInferenceHandler
+}
+
+
+def start_service(name, port=0, latency=0.0, **options):
+    """Start a fake service on a background thread and return the server.
+
+    port=0 picks a free port; read it back from server.server_address. Extra
+    options override the handler's class attributes, e.g. error_rate.
+    """
+    attributes = {"latency": latency, **options}
+    if name == "inference":
+        # Each server counts its own calls
+        attributes.update(calls={}, calls_lock=threading.Lock())
+    handler = type(SERVICES[name].__name__, (SERVICES[name],), attributes)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stand-in for an external service")
+    parser.add_argument("service", choices=sorted(SERVICES))
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="inference: share of calls that fail with 503")
+    parser.add_argument("--loading-requests", type=int, default=0, help="inference: calls per model answered with 'Model is loading'")
+    parser.add_argument("--no-stream", action="store_true", help="inference: ignore stream requests")
+    parser.add_argument("--stream-stall", type=float, default=0.0, help="inference: seconds before a stream's first token")
+    args = parser.parse_args()
+
+    options = {}
+    if args.service == "inference":
+        options = {
+            "error_rate": args.error_rate,
+            "loading_requests": args.loading_requests,
+            "stream": not args.no_stream,
+            "stream_stall": args.stream_stall
+        }
+    server = start_service(args.service, args.port, args.latency, **options)
+    print(f"Fake {args.service} listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""app.py is a Streamlit script that renders the page when it is imported, so
+tests execute only the top-level definitions they exercise."""
+import ast
+from pathlib import Path
+
+import pytest
+
+APP_PATH = Path(__file__).resolve().parent.parent / "app.py"
+
+
+def load_app(*names):
+    """Return a namespace holding app.py's imports and the named definitions or constants"""
+    tree = ast.parse(APP_PATH.read_text(encoding="utf-8"))
+    namespace = {}
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            try:
+                exec(compile(ast.Module([node], []), str(APP_PATH), "exec"), namespace)
+            except ImportError:
+                # Third-party packages the definitions under test do not need
+                pass
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            defined = [node.name]
+        elif isinstance(node, ast.Assign):
+            defined = [target.id for target in node.targets if isinstance(target, ast.Name)]
+        else:
+            continue
+        if any(name in names for name in defined):
+            exec(compile(ast.Module([node], []), str(APP_PATH), "exec"), namespace)
+    missing = [name for name in names if name not in namespace]
+    if missing:
+        raise LookupError(f"app.py does not define {missing}")
+    return namespace
+
+
+@pytest.fixture
+def app():
+    return load_app
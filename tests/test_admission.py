@@ -0,0 +1,113 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+@pytest.fixture
+def admission(app):
+    return app("AdmissionController", "AdmissionRejected", "TokenBucket", "Deadline")
+
+
+def test_burst_is_admitted_without_waiting(admission):
+    controller = admission["AdmissionController"](1, 3, 100, 100, max_waiting=4)
+    waits = [controller.acquire("token", "model", "session") for _ in range(3)]
+    assert waits == pytest.approx([0, 0, 0], abs=0.01)
+    assert controller.stats()["admitted"] == 3
+
+
+def test_wait_gives_up_at_the_deadline(admission):
+    controller = admission["AdmissionController"](1, 1, 100, 100, max_waiting=4)
+    controller.acquire("token", "model", "session")
+    started = time.monotonic()
+    assert controller.acquire("token", "model", "session", admission["Deadline"](0.2)) is None
+    assert time.monotonic() - started < 0.5
+    assert controller.stats()["waiting"] == 0
+
+
+def test_cancel_event_stops_the_wait(admission):
+    controller = admission["AdmissionController"](0.1, 1, 100, 100, max_waiting=4)
+    controller.acquire("token", "model", "session")
+    cancel_event = threading.Event()
+    threading.Timer(0.1, cancel_event.set).start()
+    started = time.monotonic()
+    assert controller.acquire("token", "model", "session", cancel_event=cancel_event) is None
+    # Well before the bucket refills in 10 s
+    assert time.monotonic() - started < 1
+
+
+def test_full_queue_rejects_right_away(admission):
+    controller = admission["AdmissionController"](1, 1, 100, 100, max_waiting=1)
+    controller.acquire("token", "model", "session")
+    waiter = threading.Thread(target=controller.acquire, args=("token", "model", "session", admission["Deadline"](0.5)))
+    waiter.start()
+    time.sleep(0.05)
+    assert controller.check() == controller.full_message
+    with pytest.raises(admission["AdmissionRejected"]):
+        controller.acquire("token", "model", "other")
+    waiter.join()
+    assert controller.stats()["rejected"] == 1
+    assert controller.check() is None
+
+
+def test_buckets_are_per_token_and_per_model(admission):
+    controller = admission["AdmissionController"](1, 1, 1, 1, max_waiting=4)
+    controller.acquire("token-a", "model-a", "session")
+    # Neither bucket is shared with the first request
+    assert controller.acquire("token-b", "model-b", "session", admission["Deadline"](0.1)) == pytest.approx(0, abs=0.01)
+    # Same model, different token: the model bucket is empty
+    assert controller.acquire("token-c", "model-a", "session", admission["Deadline"](0.1)) is None
+
+
+def test_sessions_take_turns(admission):
+    controller = admission["AdmissionController"](20, 1, 100, 100, max_waiting=10)
+    controller.acquire("token", "model", "busy")
+    order = []
+    lock = threading.Lock()
+
+    def request(session):
+        controller.acquire("token", "model", session, admission["Deadline"](5))
+        with lock:
+            order.append(session)
+
+    threads = [threading.Thread(target=request, args=("busy",)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.01)
+    quiet = threading.Thread(target=request, args=("quiet",))
+    quiet.start()
+    for thread in threads + [quiet]:
+        thread.join()
+    # The quiet session is served next, ahead of the busy session's backlog
+    assert order.index("quiet") <= 1
+
+
+def test_full_queue_ends_the_hedged_race(app):
+    namespace = app("HEDGE_DELAY", "TURN_DEADLINE", "AdmissionRejected", "Deadline", "is_good_response", "generate_hedged")
+    pool = ThreadPoolExecutor(max_workers=2)
+    namespace["get_generation_pool"] = lambda: pool
+    launched = []
+
+    def query(model, prompt, cancel_event):
+        launched.append(model)
+        raise namespace["AdmissionRejected"]("full")
+
+    with pytest.raises(namespace["AdmissionRejected"]):
+        namespace["generate_hedged"](["a", "b"], query, lambda model: model, hedge_delay=5)
+    # A rejection is not a model failure, so no other model is tried
+    assert launched == ["a"]
+    pool.shutdown()
+
+
+def test_full_queue_is_raised_from_a_stream(app):
+    namespace = app("AdmissionRejected", "Deadline", "is_good_response", "stream_text_response")
+
+    def open_text_stream(*args):
+        raise namespace["AdmissionRejected"]("full")
+
+    namespace["open_text_stream"] = open_text_stream
+    with pytest.raises(namespace["AdmissionRejected"]):
+        namespace["stream_text_response"](
+            "model", "prompt", "token", "session", None, None, threading.Event(), namespace["Deadline"](5)
+        )
@@ -0,0 +1,120 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+requests = pytest.importorskip("requests")
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    """Answers each POST with the next (status, headers, body) in the server's script"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.calls.append(time.monotonic())
+        status, headers, body = self.server.script.pop(0)
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedHandler)
+    httpd.calls = []
+    httpd.script = []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+
+
+@pytest.fixture
+def api(app, server):
+    namespace = app(
+        "CONNECT_TIMEOUT", "TEXT_READ_TIMEOUT", "TURN_DEADLINE", "RETRY_BASE_DELAY", "RETRYABLE_STATUSES",
+        "ModelHealth", "AdmissionRejected", "TokenBucket", "AdmissionController", "Deadline",
+        "parse_response_body", "is_model_loading", "retry_delay", "wait_before_retry", "make_api_request"
+    )
+    services = SimpleNamespace(
+        http=requests.Session(),
+        health=namespace["ModelHealth"](failure_threshold=5, cooldown=60),
+        admission=namespace["AdmissionController"](100, 100, 100, 100, max_waiting=10)
+    )
+
+    def request(deadline=5, **kwargs):
+        return namespace["make_api_request"](
+            f"http://127.0.0.1:{server.server_address[1]}/models/test",
+            {"inputs": "hi"},
+            token="hf_test",
+            session_id="session",
+            model="test",
+            deadline=namespace["Deadline"](deadline),
+            services=services,
+            **kwargs
+        )
+
+    return SimpleNamespace(request=request, services=services, namespace=namespace)
+
+
+def test_retry_after_is_honored(api, server):
+    server.script = [(503, {"Retry-After": "0.3"}, {"error": "busy"}), (200, {}, [{"generated_text": "ok"}])]
+    response, body = api.request()
+    assert response.status_code == 200
+    assert body == [{"generated_text": "ok"}]
+    assert server.calls[1] - server.calls[0] >= 0.3
+    assert api.services.health.snapshot()[0]["error_rate"] == 0.5
+
+
+def test_model_loading_waits_for_estimated_time(api, server):
+    server.script = [
+        (503, {}, {"error": "Model test is currently loading", "estimated_time": 0.2}),
+        (200, {}, [{"generated_text": "ok"}])
+    ]
+    response, _ = api.request()
+    assert response.status_code == 200
+    assert server.calls[1] - server.calls[0] >= 0.2
+    assert api.services.health.snapshot()[0]["loading"] is False
+
+
+def test_no_retry_when_the_wait_would_overrun_the_deadline(api, server):
+    server.script = [(429, {"Retry-After": "10"}, {"error": "slow down"})]
+    started = time.monotonic()
+    response, _ = api.request(deadline=2)
+    assert response.status_code == 429
+    assert len(server.calls) == 1
+    assert time.monotonic() - started < 1
+
+
+def test_gives_up_after_max_retries(api, server):
+    server.script = [(503, {"Retry-After": "0"}, {"error": "down"})] * 3
+    response, _ = api.request(max_retries=3)
+    assert response.status_code == 503
+    assert len(server.calls) == 3
+
+
+def test_expired_deadline_or_cancel_sends_nothing(api, server):
+    assert api.request(deadline=0) == (None, None)
+    cancel_event = threading.Event()
+    cancel_event.set()
+    assert api.request(cancel_event=cancel_event) == (None, None)
+    assert server.calls == []
+
+
+def test_retry_delay_prefers_server_hints(api):
+    retry_delay = api.namespace["retry_delay"]
+    response = SimpleNamespace(headers={"Retry-After": "7"})
+    assert retry_delay(0, response) == 7
+    assert retry_delay(0, SimpleNamespace(headers={}), {"estimated_time": 3}) == 3
+    base = api.namespace["RETRY_BASE_DELAY"]
+    assert all(0 <= retry_delay(2) <= base * 4 for _ in range(20))
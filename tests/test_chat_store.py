@@ -0,0 +1,86 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def ChatStore(app):
+    namespace = app("GUEST_ID_PREFIX", "ChatStore", "chat_title")
+    return lambda db_path, max_cached_chats, guest_ttl=3600: namespace["ChatStore"](db_path, max_cached_chats, guest_ttl)
+
+
+def test_messages_round_trip(ChatStore, tmp_path):
+    db_path = str(tmp_path / "chats.db")
+    store = ChatStore(db_path, max_cached_chats=2)
+    store.append_message("chat", "alice", "user", "Hello there")
+    store.append_message("chat", "alice", "assistant", "Hi!")
+
+    expected = [{"role": "user", "content": "Hello there"}, {"role": "assistant", "content": "Hi!"}]
+    assert store.load_messages("chat") == expected
+    # A cached chat keeps receiving new messages
+    store.append_message("chat", "alice", "user", "Bye")
+    assert store.load_messages("chat")[-1] == {"role": "user", "content": "Bye"}
+    assert ChatStore(db_path, max_cached_chats=2).load_messages("chat") == store.load_messages("chat")
+
+
+def test_message_cache_is_bounded(ChatStore, tmp_path):
+    store = ChatStore(str(tmp_path / "chats.db"), max_cached_chats=2)
+    for chat_id in ("a", "b", "c"):
+        store.append_message(chat_id, "alice", "user", chat_id)
+        store.load_messages(chat_id)
+    assert list(store.cached) == ["b", "c"]
+
+
+def test_list_chats_pages_searches_and_titles(ChatStore, tmp_path):
+    store = ChatStore(str(tmp_path / "chats.db"), max_cached_chats=2)
+    for number in range(5):
+        store.append_message(f"chat{number}", "alice", "assistant", "Welcome")
+        store.append_message(f"chat{number}", "alice", "user", f"Question {number} about 100% cotton")
+    store.append_message("other", "bob", "user", "Not Alice's")
+
+    chats, total = store.list_chats("alice", limit=2, offset=0)
+    assert total == 5
+    assert chats == [("chat4", "Question 4 about 100% cotton"), ("chat3", "Question 3 about 100% cotton")]
+    assert store.list_chats("alice", limit=2, offset=4)[0] == [("chat0", "Question 0 about 100% cotton")]
+    # LIKE wildcards in the search are matched literally
+    assert store.list_chats("alice", search="0%")[1] == 5
+    assert store.list_chats("alice", search="_")[1] == 0
+    assert store.list_chats("alice", search="question 2")[0] == [("chat2", "Question 2 about 100% cotton")]
+
+
+def test_older_databases_are_migrated(ChatStore, tmp_path):
+    db_path = str(tmp_path / "chats.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE chats (chat_id TEXT PRIMARY KEY, user_id TEXT, title TEXT, created_date TEXT)")
+    conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT NOT NULL, "
+                 "role TEXT NOT NULL, content TEXT NOT NULL, created_at REAL NOT NULL)")
+    conn.execute("INSERT INTO chats VALUES ('old', 'alice', NULL, '2024-01-01')")
+    conn.execute("INSERT INTO messages (chat_id, role, content, created_at) VALUES ('old', 'user', 'First question', 5)")
+    conn.commit()
+    conn.close()
+
+    store = ChatStore(db_path, max_cached_chats=2)
+    assert store.list_chats("alice") == ([("old", "First question")], 1)
+    assert store.conn.execute("SELECT updated_at FROM chats").fetchone()[0] == 5
+
+
+def test_idle_guest_chats_are_deleted(ChatStore, tmp_path):
+    db_path = str(tmp_path / "chats.db")
+    store = ChatStore(db_path, max_cached_chats=2)
+    store.append_message("guest-chat", "guest:1234", "user", "Guest question")
+    store.append_message("account-chat", "alice", "user", "Alice's question")
+    store.conn.execute("UPDATE chats SET updated_at = 0")
+    store.conn.commit()
+
+    store = ChatStore(db_path, max_cached_chats=2, guest_ttl=60)
+    assert store.list_chats("guest:1234") == ([], 0)
+    assert store.load_messages("guest-chat") == []
+    assert store.list_chats("alice") == ([("account-chat", "Alice's question")], 1)
+
+
+def test_guest_chats_move_to_an_account(ChatStore, tmp_path):
+    store = ChatStore(str(tmp_path / "chats.db"), max_cached_chats=2)
+    store.append_message("chat", "guest:1234", "user", "Asked before signing in")
+    store.move_chats("guest:1234", "alice")
+    assert store.list_chats("alice") == ([("chat", "Asked before signing in")], 1)
+    assert store.list_chats("guest:1234") == ([], 0)
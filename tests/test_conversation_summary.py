@@ -0,0 +1,60 @@
+import pytest
+
+
+@pytest.fixture
+def summary(app, tmp_path):
+    namespace = app(
+        "MODEL_CONTEXT_TOKENS", "RESPONSE_TOKENS", "CONTEXT_TOKENS", "CONTEXT_RECENT_MESSAGES", "SUMMARY_LINE_TOKENS",
+        "TieredCache", "count_tokens", "truncate_to_tokens", "prompt_token_budget", "speaker",
+        "summarize_message", "update_conversation_summary", "conversation_context"
+    )
+    # Estimate tokens instead of downloading a tokenizer
+    namespace["get_tokenizer"] = lambda model: None
+    cache = namespace["TieredCache"](str(tmp_path / "cache.db"), "chat_summaries", ttl=60, max_entries=4)
+    namespace["get_summary_cache"] = lambda: cache
+    return namespace
+
+
+def chat(count):
+    return [
+        {"role": "user" if index % 2 == 0 else "assistant", "content": f"Message {index}. More detail follows here."}
+        for index in range(count)
+    ]
+
+
+def test_summary_lines_keep_the_speaker_and_first_sentence(summary):
+    line = summary["summarize_message"]({"role": "assistant", "content": "Paris is the capital.  It is in France."})
+    assert line == "Assistant: Paris is the capital."
+
+
+def test_only_messages_leaving_the_recent_window_are_summarized(summary):
+    recent = summary["CONTEXT_RECENT_MESSAGES"]
+    update = summary["update_conversation_summary"]
+    assert update("chat", chat(recent)) == []
+
+    lines = update("chat", chat(recent + 2))
+    assert lines == ["User: Message 0.", "Assistant: Message 1."]
+    # Already summarized messages are not summarized again
+    summary["summarize_message"] = lambda message: pytest.fail("summarized twice")
+    assert update("chat", chat(recent + 2)) == lines
+
+
+def test_summary_stays_bounded_in_long_chats(summary):
+    budget = summary["CONTEXT_TOKENS"] // 2
+    lines = summary["update_conversation_summary"]("chat", chat(500))
+    assert summary["count_tokens"]("\n".join(lines), None) <= budget
+    # The oldest lines are the ones dropped
+    assert lines[-1] == f"Assistant: Message {500 - summary['CONTEXT_RECENT_MESSAGES'] - 1}."
+
+
+def test_context_prefers_recent_messages_within_budget(summary):
+    context = summary["conversation_context"]
+    assert context([], [], None) == ""
+
+    recent = [{"role": "user", "content": "word " * 2000}]
+    rendered = context(["User: an older question."], recent, None)
+    assert rendered.startswith("Recent messages:")
+    assert summary["count_tokens"](rendered, None) <= summary["CONTEXT_TOKENS"]
+
+    rendered = context(["User: an older question."], [{"role": "user", "content": "Short."}], None)
+    assert rendered == "Earlier in this conversation:\nUser: an older question.\n\nRecent messages:\nUser: Short."
@@ -0,0 +1,68 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+GOOD = "A complete answer that is long enough to keep."
+
+
+@pytest.fixture
+def hedged(app):
+    namespace = app("HEDGE_DELAY", "TURN_DEADLINE", "Deadline", "is_good_response", "generate_hedged")
+    pool = ThreadPoolExecutor(max_workers=4)
+    namespace["get_generation_pool"] = lambda: pool
+    yield namespace
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def answers(delays_and_texts):
+    """A query that answers each model after a delay"""
+    def query(model, prompt, cancel_event):
+        delay, text = delays_and_texts[model]
+        cancel_event.wait(delay)
+        return text
+    return query
+
+
+def test_slow_model_is_hedged(hedged):
+    query = answers({"slow": (2, GOOD), "fast": (0, GOOD + " Fast.")})
+    started = time.monotonic()
+    result = hedged["generate_hedged"](["slow", "fast"], query, lambda model: model, hedge_delay=0.1)
+    assert result == ("fast", GOOD + " Fast.")
+    assert time.monotonic() - started < 1
+
+
+def test_failed_model_is_replaced_without_waiting(hedged):
+    query = answers({"broken": (0, ""), "backup": (0, GOOD)})
+    started = time.monotonic()
+    assert hedged["generate_hedged"](["broken", "backup"], query, lambda model: model, hedge_delay=5) == ("backup", GOOD)
+    assert time.monotonic() - started < 1
+
+
+def test_short_answer_is_the_fallback(hedged):
+    query = answers({"terse": (0, "Too short"), "broken": (0, "")})
+    assert hedged["generate_hedged"](["terse", "broken"], query, lambda model: model, hedge_delay=5) == ("terse", "Too short")
+
+
+def test_deadline_stops_waiting(hedged):
+    query = answers({"slow": (5, GOOD)})
+    started = time.monotonic()
+    result = hedged["generate_hedged"](["slow"], query, lambda model: model, hedge_delay=5, deadline=hedged["Deadline"](0.2))
+    assert result == (None, "")
+    assert time.monotonic() - started < 1
+
+
+def test_prompts_are_built_on_the_calling_thread_for_launched_models_only(hedged):
+    built = []
+
+    def prompt_for(model):
+        built.append((model, threading.current_thread()))
+        return f"prompt for {model}"
+
+    def query(model, prompt, cancel_event):
+        assert prompt == f"prompt for {model}"
+        return GOOD
+
+    assert hedged["generate_hedged"](["first", "second"], query, prompt_for, hedge_delay=5) == ("first", GOOD)
+    assert built == [("first", threading.current_thread())]
@@ -0,0 +1,131 @@
+import io
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def png_bytes(size=64):
+    output = io.BytesIO()
+    Image.new("RGB", (size, size), "teal").save(output, format="PNG")
+    return output.getvalue()
+
+
+@pytest.fixture
+def images(app, tmp_path):
+    namespace = app(
+        "HF_API_BASE", "IMAGE_MODELS", "IMAGE_DEADLINE", "IMAGE_READ_TIMEOUT", "PREVIEW_SIZE", "PREVIEW_QUALITY",
+        "ModelHealth", "AdmissionRejected", "TokenBucket", "AdmissionController", "Trace", "MetricsLog",
+        "Deadline", "hf_model_url", "image_generation_payload", "image_fingerprint", "ImageStore",
+        "make_preview", "preview_key", "get_or_make_preview", "ImageJobQueue"
+    )
+    services = SimpleNamespace(
+        health=namespace["ModelHealth"](failure_threshold=5, cooldown=60),
+        admission=namespace["AdmissionController"](100, 100, 100, 100, max_waiting=10),
+        metrics=namespace["MetricsLog"](str(tmp_path / "metrics.jsonl"), max_bytes=10**6),
+        image_store=namespace["ImageStore"](str(tmp_path / "images"), max_memory_bytes=10**6, max_disk_bytes=10**7)
+    )
+    calls = []
+    # Each test sets how the fake inference API answers
+    answer = {"respond": lambda model, cancel_event: (SimpleNamespace(status_code=200, content=png_bytes()), None)}
+
+    def fake_request(url, payload, cancel_event=None, model=None, **kwargs):
+        calls.append(model)
+        return answer["respond"](model, cancel_event)
+
+    namespace["make_api_request"] = fake_request
+
+    def make_queue(max_workers=2, max_active=4, per_user_limit=2, job_ttl=60):
+        return namespace["ImageJobQueue"](max_workers, max_active, per_user_limit, job_ttl, services)
+
+    return SimpleNamespace(make_queue=make_queue, calls=calls, answer=answer, services=services, namespace=namespace)
+
+
+def wait_for(queue, job_id, timeout=5):
+    until = time.monotonic() + timeout
+    while time.monotonic() < until:
+        job = queue.get(job_id)
+        if job["state"] not in ("queued", "running"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job still {job['state']}")
+
+
+def test_job_finishes_and_repeat_prompt_is_served_from_the_store(images):
+    queue = images.make_queue()
+    job_id, rejection = queue.submit("alice", "a lighthouse", "hf_test")
+    assert rejection is None
+    job = wait_for(queue, job_id)
+    assert job["state"] == "done"
+    assert job["image_bytes"] == png_bytes()
+    assert job["preview_bytes"] != job["image_bytes"]
+    assert images.calls == [images.namespace["IMAGE_MODELS"][0]]
+
+    job_id, _ = queue.submit("bob", "a lighthouse", "hf_test")
+    # Done straight away, without a worker or another API call
+    assert queue.get(job_id)["state"] == "done"
+    assert len(images.calls) == 1
+
+
+def test_per_user_limit_and_full_queue_reject_new_jobs(images):
+    release = threading.Event()
+
+    def blocked(model, cancel_event):
+        release.wait(5)
+        return SimpleNamespace(status_code=200, content=png_bytes()), None
+
+    images.answer["respond"] = blocked
+    queue = images.make_queue(max_active=2, per_user_limit=1)
+    first, _ = queue.submit("alice", "one", "hf_test")
+    assert queue.submit("alice", "two", "hf_test")[0] is None
+    second, _ = queue.submit("bob", "three", "hf_test")
+    job_id, rejection = queue.submit("carol", "four", "hf_test")
+    assert job_id is None
+    assert "busy" in rejection
+
+    release.set()
+    assert wait_for(queue, first)["state"] == "done"
+    assert wait_for(queue, second)["state"] == "done"
+    assert queue.submit("alice", "two", "hf_test")[1] is None
+
+
+def test_cancel_stops_a_running_job(images):
+    started = threading.Event()
+
+    def until_cancelled(model, cancel_event):
+        started.set()
+        cancel_event.wait(5)
+        return None, None
+
+    images.answer["respond"] = until_cancelled
+    queue = images.make_queue()
+    job_id, _ = queue.submit("alice", "a slow one", "hf_test")
+    assert started.wait(5)
+    queue.cancel(job_id)
+    time.sleep(0.05)
+    job = queue.get(job_id)
+    assert job["state"] == "cancelled"
+    assert job["image_bytes"] is None
+    # The worker gave up instead of trying the next model
+    assert len(images.calls) == 1
+
+
+def test_invalid_token_fails_without_trying_other_models(images):
+    images.answer["respond"] = lambda model, cancel_event: (SimpleNamespace(status_code=401, content=b""), None)
+    queue = images.make_queue()
+    job_id, _ = queue.submit("alice", "anything", "hf_bad")
+    job = wait_for(queue, job_id)
+    assert job["state"] == "failed"
+    assert "Invalid API token" in job["errors"][0]
+    assert len(images.calls) == 1
+
+
+def test_finished_jobs_expire_on_get(images):
+    queue = images.make_queue(job_ttl=0.05)
+    job_id, _ = queue.submit("alice", "fleeting", "hf_test")
+    wait_for(queue, job_id)
+    time.sleep(0.1)
+    assert queue.get(job_id) is None
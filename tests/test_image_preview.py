@@ -0,0 +1,41 @@
+import io
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def preview(app, tmp_path):
+    namespace = app("PREVIEW_SIZE", "PREVIEW_QUALITY", "ImageStore", "make_preview", "preview_key", "get_or_make_preview")
+    namespace["store"] = namespace["ImageStore"](str(tmp_path / "images"), max_memory_bytes=10**6, max_disk_bytes=10**7)
+    return namespace
+
+
+def png_bytes(size):
+    output = io.BytesIO()
+    # Noise, so the PNG is not trivially small
+    Image.effect_noise((size, size), 64).convert("RGB").save(output, format="PNG")
+    return output.getvalue()
+
+
+def test_preview_is_downscaled_and_smaller(preview):
+    original = png_bytes(1024)
+    preview_bytes = preview["make_preview"](original)
+    image = Image.open(io.BytesIO(preview_bytes))
+    assert max(image.size) == preview["PREVIEW_SIZE"]
+    assert image.format in ("WEBP", "JPEG")
+    assert len(preview_bytes) < len(original)
+
+
+def test_preview_is_transcoded_once(preview):
+    calls = []
+    make_preview = preview["make_preview"]
+    preview["make_preview"] = lambda image_bytes: calls.append(1) or make_preview(image_bytes)
+    original = png_bytes(600)
+
+    first = preview["get_or_make_preview"]("key", original, preview["store"])
+    second = preview["get_or_make_preview"]("key", original, preview["store"])
+    assert first == second
+    assert len(calls) == 1
+    assert preview["store"].get(preview["preview_key"]("key")) == first
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def ImageStore(app):
+    return app("ImageStore")["ImageStore"]
+
+
+def test_images_survive_a_new_instance(ImageStore, tmp_path):
+    directory = str(tmp_path / "images")
+    ImageStore(directory, max_memory_bytes=1000, max_disk_bytes=1000).put("key", b"image")
+    assert ImageStore(directory, max_memory_bytes=1000, max_disk_bytes=1000).get("key") == b"image"
+    assert ImageStore(directory, max_memory_bytes=1000, max_disk_bytes=1000).get("other") is None
+
+
+def test_memory_tier_is_bounded_by_size(ImageStore, tmp_path):
+    store = ImageStore(str(tmp_path / "images"), max_memory_bytes=250, max_disk_bytes=10000)
+    for key in ("a", "b", "c"):
+        store.put(key, key.encode() * 100)
+    assert list(store.entries) == ["b", "c"]
+    assert store.memory_bytes == 200
+    # The evicted image is still on disk
+    assert store.get("a") == b"a" * 100
+
+
+def test_disk_tier_evicts_least_recently_used(ImageStore, tmp_path):
+    directory = str(tmp_path / "images")
+    store = ImageStore(directory, max_memory_bytes=10000, max_disk_bytes=250)
+    store.put("a", b"a" * 100)
+    store.put("b", b"b" * 100)
+    os.utime(os.path.join(directory, "a.img"), (1, 1))
+    os.utime(os.path.join(directory, "b.img"), (2, 2))
+    # Reading from disk marks "a" as recently used
+    assert ImageStore(directory, max_memory_bytes=10000, max_disk_bytes=250).get("a") == b"a" * 100
+    store.put("c", b"c" * 100)
+    assert sorted(os.listdir(directory)) == ["a.img", "c.img"]
+
+
+def test_put_leaves_no_partial_files(ImageStore, tmp_path):
+    directory = str(tmp_path / "images")
+    store = ImageStore(directory, max_memory_bytes=1000, max_disk_bytes=1000)
+    store.put("key", b"first")
+    store.put("key", b"second")
+    assert os.listdir(directory) == ["key.img"]
+    assert ImageStore(directory, max_memory_bytes=1000, max_disk_bytes=1000).get("key") == b"second"
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def scheduler(app):
+    """A LocalBatchScheduler whose model echoes prompts and records each batch"""
+    LocalBatchScheduler = app("LocalBatchScheduler")["LocalBatchScheduler"]
+
+    def make(max_batch_size=3, max_wait=0.1, fail=False):
+        scheduler = LocalBatchScheduler(max_batch_size, max_wait)
+        scheduler.batches = []
+        scheduler.release = threading.Event()
+        scheduler.release.set()
+
+        def generate(model, prompts):
+            scheduler.release.wait()
+            scheduler.batches.append((model, list(prompts)))
+            if fail:
+                raise RuntimeError("out of memory")
+            return [f"{model} answers {prompt}" for prompt in prompts]
+
+        scheduler._generate = generate
+        return scheduler
+
+    return make
+
+
+def test_prompts_arriving_together_share_a_batch(scheduler):
+    local = scheduler()
+    futures = [local.submit("gpt2", f"q{number}") for number in range(3)]
+    assert [future.result(timeout=2) for future in futures] == ["gpt2 answers q0", "gpt2 answers q1", "gpt2 answers q2"]
+    assert local.batches == [("gpt2", ["q0", "q1", "q2"])]
+
+
+def test_batches_are_capped_and_other_models_get_a_turn(scheduler):
+    local = scheduler(max_batch_size=2, max_wait=0.05)
+    local.release.clear()
+    first = local.submit("gpt2", "warm up")
+    time.sleep(0.1)
+    # The worker is busy, so these queue up behind it
+    futures = [local.submit("gpt2", f"q{number}") for number in range(3)] + [local.submit("opt", "other")]
+    local.release.set()
+    for future in [first] + futures:
+        future.result(timeout=2)
+    assert local.batches == [
+        ("gpt2", ["warm up"]),
+        ("gpt2", ["q0", "q1"]),
+        ("opt", ["other"]),
+        ("gpt2", ["q2"])
+    ]
+    assert local.queue_depth() == 0
+
+
+def test_failure_reaches_every_prompt_in_the_batch(scheduler):
+    local = scheduler(fail=True)
+    futures = [local.submit("gpt2", "a"), local.submit("gpt2", "b")]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="out of memory"):
+            future.result(timeout=2)
+
+
+def test_cancelled_prompts_are_not_generated(scheduler):
+    local = scheduler(max_wait=0.2)
+    cancelled = local.submit("gpt2", "never mind")
+    kept = local.submit("gpt2", "keep")
+    assert cancelled.cancel()
+    assert kept.result(timeout=2) == "gpt2 answers keep"
+    assert local.batches == [("gpt2", ["keep"])]
@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def ModelHealth(app):
+    return app("ModelHealth")["ModelHealth"]
+
+
+def circuit(health, model):
+    return next(row["circuit"] for row in health.snapshot() if row["model"] == model)
+
+
+def test_circuit_opens_after_consecutive_failures(ModelHealth):
+    health = ModelHealth(failure_threshold=2, cooldown=60)
+    health.record_failure("a")
+    # Still offered, behind the model that has not failed
+    assert health.rank(["a", "b"]) == ["b", "a"]
+    health.record_failure("a")
+    assert circuit(health, "a") == "open"
+    assert health.rank(["a", "b"]) == ["b"]
+
+
+def test_success_resets_the_failure_count(ModelHealth):
+    health = ModelHealth(failure_threshold=2, cooldown=60)
+    health.record_failure("a")
+    health.record_success("a", 1.0)
+    health.record_failure("a")
+    assert circuit(health, "a") == "closed"
+
+
+def test_trial_after_cooldown_closes_or_reopens(ModelHealth):
+    health = ModelHealth(failure_threshold=2, cooldown=0.1)
+    for _ in range(2):
+        health.record_failure("a")
+        health.record_failure("b")
+    time.sleep(0.15)
+    # Half open: both are offered for a trial request
+    assert set(health.rank(["a", "b"])) == {"a", "b"}
+
+    health.record_success("a", 1.0)
+    health.record_failure("b")
+    assert circuit(health, "a") == "closed"
+    # One failed trial is enough to reopen
+    assert circuit(health, "b") == "open"
+    assert health.rank(["a", "b"]) == ["a"]
+
+
+def test_all_open_returns_soonest_to_recover_first(ModelHealth):
+    health = ModelHealth(failure_threshold=1, cooldown=60)
+    health.record_failure("a")
+    time.sleep(0.01)
+    health.record_failure("b")
+    assert health.rank(["b", "a"]) == ["a", "b"]
+
+
+def test_faster_and_more_reliable_models_rank_first(ModelHealth):
+    health = ModelHealth(failure_threshold=10, cooldown=60, latency_prior=5.0)
+    health.record_success("slow", 4.0)
+    health.record_success("fast", 1.0)
+    health.record_success("flaky", 1.0)
+    for _ in range(3):
+        health.record_failure("flaky")
+    # flaky: 1 s at a 25% success rate is expected to take 4 s; unseen models assume 5 s
+    assert health.rank(["unseen", "slow", "flaky", "fast"]) == ["fast", "slow", "flaky", "unseen"]
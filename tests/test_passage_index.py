@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def ranking(app):
+    return app("PASSAGE_WORDS", "split_passages", "index_terms", "PassageIndex")
+
+
+def test_split_passages_keeps_sentences_and_skips_headings(ranking):
+    text = "One two three. Four five six.\n\n== History ==\nSeven eight nine."
+    assert ranking["split_passages"](text, max_words=4) == ["One two three.", "Four five six.", "Seven eight nine."]
+    assert ranking["split_passages"](text, max_words=10) == ["One two three. Four five six.", "Seven eight nine."]
+
+
+def test_best_matches_come_first(ranking):
+    index = ranking["PassageIndex"]()
+    index.add_source("a", ["Cats purr and sleep all day.", "Dogs bark at the mail carrier."])
+    index.add_source("b", ["Guido van Rossum created Python.", "Python is a programming language."])
+
+    top = index.top("who created python", 2)
+    assert top[0] == ("b", 0, "Guido van Rossum created Python.")
+    assert top[1] == ("b", 1, "Python is a programming language.")
+
+
+def test_sources_are_indexed_incrementally(ranking):
+    index = ranking["PassageIndex"]()
+    index.add_source("a", ["Rare word zebra here.", "Common word here."])
+    before = index.scores("zebra")
+    index.add_source("b", ["Another zebra sighting.", "Nothing else."])
+    after = index.scores("zebra")
+
+    assert len(index.postings) == 2
+    assert len(after) == 4
+    # A term that becomes more common is worth less
+    assert after[0] < before[0]
+    assert after[1] == after[3] == 0
+
+
+def test_unknown_query_keeps_source_order(ranking):
+    index = ranking["PassageIndex"]()
+    index.add_source("a", ["First passage.", "Second passage."])
+    assert [passage for _, _, passage in index.top("unrelated", 5)] == ["First passage.", "Second passage."]
+    assert ranking["PassageIndex"]().top("anything", 3) == []
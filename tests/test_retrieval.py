@@ -0,0 +1,47 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("requests")
+
+
+@pytest.fixture
+def retrieval(app):
+    namespace = app("CONNECT_TIMEOUT", "Deadline", "retrieval_timeout", "run_retrieval")
+    pool = ThreadPoolExecutor(max_workers=1)
+    namespace.update(
+        RETRIEVAL_DEADLINES={"slow": 0.2, "fast": 1},
+        Services=lambda: None,
+        get_retrieval_pool=lambda: pool
+    )
+    yield namespace
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def wait_out(topic, services, deadline):
+    """Stands in for a request that runs until its timeout"""
+    time.sleep(deadline.remaining())
+    raise TimeoutError
+
+
+def answer(topic, services, deadline):
+    return f"about {topic}"
+
+
+def test_timeout_is_bounded_by_the_deadline(retrieval):
+    connect, read = retrieval["retrieval_timeout"](retrieval["Deadline"](0.5))
+    assert connect <= 0.5 and read <= 0.5
+    with pytest.raises(retrieval["requests"].exceptions.Timeout):
+        retrieval["retrieval_timeout"](retrieval["Deadline"](0))
+
+
+def test_dropped_lookup_frees_its_worker(retrieval):
+    results, errors = retrieval["run_retrieval"]({"slow": (wait_out, "python")})
+    assert results == {"slow": None}
+    assert errors == ["Slow lookup took too long and was skipped"]
+
+    # The only worker was held by the dropped lookup until its deadline
+    results, errors = retrieval["run_retrieval"]({"fast": (answer, "python")})
+    assert results == {"fast": "about python"}
+    assert errors == []
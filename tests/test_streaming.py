@@ -0,0 +1,163 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+GOOD = "A streamed answer that is long enough to keep."
+
+
+class FakeStream:
+    """An open server-sent event response"""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.closed = False
+
+    def iter_lines(self, decode_unicode=False):
+        yield from self.lines
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def event(text, special=False):
+    return "data: " + json.dumps({"token": {"text": text, "special": special}, "generated_text": None})
+
+
+class Health:
+    def __init__(self):
+        self.outcomes = []
+
+    def record_success(self, model, latency):
+        self.outcomes.append("success")
+
+    def record_failure(self, model, loading=False):
+        self.outcomes.append("failure")
+
+
+@pytest.fixture
+def streaming(app):
+    namespace = app(
+        "HEDGE_DELAY", "TURN_DEADLINE", "AdmissionRejected", "Deadline", "is_good_response",
+        "iter_stream_tokens", "TokenStream", "stream_text_response", "generate_hedged"
+    )
+    pool = ThreadPoolExecutor(max_workers=4)
+    namespace["get_generation_pool"] = lambda: pool
+    yield namespace
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def stream_answer(streaming, opened, deadline=5, cancel_event=None):
+    """Run stream_text_response against whatever opened returns; returns (text, health outcomes, chunks)"""
+    streaming["open_text_stream"] = lambda *args: opened
+    health = Health()
+    chunks = []
+    text = streaming["stream_text_response"](
+        "model", "prompt", "token", "session", SimpleNamespace(health=health),
+        SimpleNamespace(put=chunks.append), cancel_event or threading.Event(), streaming["Deadline"](deadline)
+    )
+    return text, health.outcomes, chunks
+
+
+def test_sse_tokens_are_parsed(streaming):
+    response = FakeStream(["", ": keep-alive", event("Hello"), event(" world"), event("</s>", special=True), "data: [DONE]", event(" ignored")])
+    assert list(streaming["iter_stream_tokens"](response)) == ["Hello", " world"]
+    assert response.closed
+
+
+def test_sse_error_event_raises(streaming):
+    response = FakeStream([event("Hi"), 'data: {"error": "Model overloaded"}'])
+    with pytest.raises(RuntimeError, match="Model overloaded"):
+        list(streaming["iter_stream_tokens"](response))
+
+
+def test_good_stream_records_success(streaming):
+    words = GOOD.split(" ")
+    response = FakeStream([event(("" if index == 0 else " ") + word) for index, word in enumerate(words)])
+    text, outcomes, chunks = stream_answer(streaming, (response, None))
+    assert text == GOOD
+    assert "".join(chunks) == GOOD
+    assert outcomes == ["success"]
+
+
+def test_short_stream_records_failure(streaming):
+    text, outcomes, _ = stream_answer(streaming, (FakeStream([event("Hi")]), None))
+    assert text == "Hi"
+    assert outcomes == ["failure"]
+
+
+def test_stream_cut_off_by_the_deadline_records_failure(streaming):
+    text, outcomes, _ = stream_answer(streaming, (FakeStream([event(GOOD)]), None), deadline=0)
+    assert text == ""
+    assert outcomes == ["failure"]
+
+
+def test_complete_answer_from_a_model_that_does_not_stream(streaming):
+    text, outcomes, chunks = stream_answer(streaming, (None, GOOD))
+    assert text == GOOD
+    assert chunks == [GOOD]
+    assert outcomes == ["success"]
+
+
+def test_unavailable_model_is_not_recorded_again(streaming):
+    # open_text_stream already recorded the error response
+    assert stream_answer(streaming, (None, None)) == ("", [], [])
+
+
+def test_cancelled_stream_is_not_recorded(streaming):
+    cancel_event = threading.Event()
+    cancel_event.set()
+    text, outcomes, _ = stream_answer(streaming, (FakeStream([event(GOOD)]), None), cancel_event=cancel_event)
+    assert outcomes == []
+
+
+def test_token_stream_renders_what_has_arrived(streaming):
+    rendered = []
+    stream = streaming["TokenStream"](SimpleNamespace(markdown=rendered.append))
+    assert stream.render() is False
+    stream.put("Hello")
+    stream.put(" there")
+    assert stream.render() is True
+    assert rendered == ["Hello there▌"]
+
+
+def test_stalled_stream_is_hedged(streaming):
+    stream = streaming["TokenStream"](SimpleNamespace(markdown=lambda text: None))
+
+    def query(model, prompt, cancel_event):
+        if model == "streaming":
+            cancel_event.wait(5)
+            return ""
+        return GOOD
+
+    started = time.monotonic()
+    result = streaming["generate_hedged"](["streaming", "hedge"], query, lambda model: model, hedge_delay=0.2, stream=stream)
+    assert result == ("hedge", GOOD)
+    assert time.monotonic() - started < 1
+
+
+def test_answering_stream_holds_hedges_back(streaming):
+    stream = streaming["TokenStream"](SimpleNamespace(markdown=lambda text: None))
+    launched = []
+
+    def query(model, prompt, cancel_event):
+        launched.append(model)
+        if model == "streaming":
+            stream.put("First words")
+            time.sleep(0.5)
+            return GOOD
+        return GOOD + " From the hedge."
+
+    result = streaming["generate_hedged"](["streaming", "hedge"], query, lambda model: model, hedge_delay=0.1, stream=stream)
+    assert result == ("streaming", GOOD)
+    assert launched == ["streaming"]
+    assert stream.text == "First words"
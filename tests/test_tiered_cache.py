@@ -0,0 +1,62 @@
+import pytest
+
+
+@pytest.fixture
+def TieredCache(app):
+    return app("TieredCache")["TieredCache"]
+
+
+def test_values_survive_a_new_instance(TieredCache, tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    TieredCache(db_path, "cache", ttl=60, max_entries=4).set("key", {"answer": [1, 2]})
+
+    cache = TieredCache(db_path, "cache", ttl=60, max_entries=4)
+    assert cache.get("key") == (True, {"answer": [1, 2]})
+    assert cache.get("key") == (True, {"answer": [1, 2]})
+    assert cache.stats == {"memory_hits": 1, "disk_hits": 1, "misses": 0}
+
+
+def test_expired_entries_are_misses(TieredCache, tmp_path):
+    cache = TieredCache(str(tmp_path / "cache.db"), "cache", ttl=-1, max_entries=4)
+    cache.set("key", "value")
+    assert cache.get("key") == (False, None)
+
+
+def test_memory_tier_is_bounded(TieredCache, tmp_path):
+    cache = TieredCache(str(tmp_path / "cache.db"), "cache", ttl=60, max_entries=2)
+    for key in ("a", "b", "c"):
+        cache.set(key, key)
+    assert list(cache.entries) == ["b", "c"]
+    # The evicted entry is still on disk
+    assert cache.get("a") == (True, "a")
+
+
+def test_get_or_fetch_normalizes_queries(TieredCache, tmp_path):
+    cache = TieredCache(str(tmp_path / "cache.db"), "cache", ttl=60, max_entries=4)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return "result"
+
+    assert cache.get_or_fetch("search", "Python  Language", fetch) == "result"
+    assert cache.get_or_fetch("search", "python language", fetch) == "result"
+    assert len(calls) == 1
+
+
+def row_count(cache):
+    return cache.conn.execute(f"SELECT COUNT(*) FROM {cache.table}").fetchone()[0]
+
+
+def test_expired_rows_are_purged_without_a_disk_bound(TieredCache, tmp_path):
+    cache = TieredCache(str(tmp_path / "cache.db"), "cache", ttl=-1, max_entries=4)
+    for number in range(100):
+        cache.set(f"key{number}", number)
+    assert row_count(cache) == 0
+
+
+def test_disk_tier_is_bounded(TieredCache, tmp_path):
+    cache = TieredCache(str(tmp_path / "cache.db"), "cache", ttl=60, max_entries=4, max_disk_entries=10)
+    for number in range(100):
+        cache.set(f"key{number}", number)
+    assert row_count(cache) == 10
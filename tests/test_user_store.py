@@ -0,0 +1,56 @@
+import hashlib
+import time
+
+import pytest
+
+
+@pytest.fixture
+def UserStore(app):
+    namespace = app("UserStore")
+    namespace["UserStore"].iterations = 1000
+    return namespace["UserStore"]
+
+
+def test_accounts_verify_their_own_password(UserStore, tmp_path):
+    users = UserStore(str(tmp_path / "users.db"), max_failures=5, lockout=60)
+    assert users.create("alice", "correct horse") is None
+    assert users.create("alice", "another password") == "That username is taken."
+    assert users.create("guest:alice", "correct horse") is not None
+    assert users.create("bob", "short") == "Passwords must be at least 8 characters."
+
+    assert users.verify("alice", "correct horse")
+    assert not users.verify("alice", "wrong horse")
+    assert not users.verify("nobody", "correct horse")
+    stored = users.conn.execute("SELECT password FROM users").fetchone()[0]
+    assert stored.startswith("pbkdf2_sha256$") and "correct horse" not in stored
+
+
+def test_legacy_hashes_are_upgraded(UserStore, tmp_path):
+    users = UserStore(str(tmp_path / "users.db"), max_failures=5, lockout=60)
+    users.conn.execute("INSERT INTO users VALUES ('carol', ?, '2024-01-01')", (hashlib.sha256(b"old password").hexdigest(),))
+    users.conn.commit()
+    assert users.verify("carol", "old password")
+    assert users.conn.execute("SELECT password FROM users").fetchone()[0].startswith("pbkdf2_sha256$")
+    assert users.verify("carol", "old password")
+
+
+def test_repeated_failures_lock_the_username(UserStore, tmp_path):
+    users = UserStore(str(tmp_path / "users.db"), max_failures=3, lockout=0.3)
+    users.create("alice", "correct horse")
+    for _ in range(3):
+        assert not users.verify("alice", "guess")
+    assert users.locked_for("alice") > 0
+    # Locked out even with the right password
+    assert not users.verify("alice", "correct horse")
+    # Unknown usernames count too, so lockouts do not reveal which accounts exist
+    for _ in range(3):
+        users.verify("nobody", "guess")
+    assert users.locked_for("nobody") > 0
+
+    time.sleep(0.35)
+    assert users.locked_for("alice") == 0
+    assert users.verify("alice", "correct horse")
+    assert "alice" not in users.failures
+    # Failures older than the lockout are forgotten when the next one is counted
+    users.verify("dave", "guess")
+    assert set(users.failures) == {"dave"}